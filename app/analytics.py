@@ -1,32 +1,72 @@
-import re
+import asyncio
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
 from datetime import datetime
-from datetime import timedelta
-from database import engine_db
+import multiprocessing
+from database import engine_db, db_chunk, comment_limit
 from database import StoppedTickets, ExpiresTickets
+from changes import ChangeTracker
+from sla import SlaEngine, breach_info, format_info
+import timestamps
+from comments import clean_comment
+import metrics
 from envparse import Env
 from log import logger
-from typing import Coroutine, Awaitable
+from typing import Coroutine, Awaitable, Callable
 from ws_server import ServerServices
-from sqlalchemy import select, update, insert
+from sqlalchemy import Table, delete, or_, literal_column
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+
+analysis_seconds = metrics.registry.histogram('analytics_analysis_seconds', 'Время разбора пачки тикетов',
+                                              ('function',))
+analysis_tickets = metrics.registry.counter('analytics_analysis_tickets_total', 'Разобранные тикеты', ('function',))
+db_write_seconds = metrics.registry.histogram('analytics_db_write_seconds', 'Время записи пачки строк в БД', ('table',))
+db_rows = metrics.registry.counter('analytics_db_rows_total', 'Строки, обработанные при записи в БД', ('table', 'result'))
+
+
+def create_executor(mode: str, workers: int) -> Executor | None:
+    """inline - анализ прямо на event loop, thread - в пуле потоков, process - в пуле процессов"""
+    if mode == 'inline':
+        return None
+    if mode == 'thread':
+        return ThreadPoolExecutor(workers)
+    if mode == 'process':
+        return ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+    raise ValueError(f"Неизвестный режим анализа: {mode}")
 
 
 class Analytics:
     """
     Класс для анализа тикетов из системы NTTM (просроченные, приостановленные):
     1. Получает информацию по тикету из класса TaskManager, вызывается нужный метод класса Analytics
-    2. После анализа тикета результат проверки добавляется в БД
+    2. После анализа тикета результат проверки добавляется в БД (асинхронно, через пул соединений)
     3. Если тикет был проверен ранее и информация в нём изменилась, он будет обновлён 
+    4. Приостановки и просрочки копятся в буфере и пишутся пачками (INSERT ... ON CONFLICT DO UPDATE)
+    5. Приостановленный тикет, задачи которого не менялись с прошлого цикла, не разбирается и не пишется
+    6. Просрочки анализируются пачкой в SlaEngine, analise остаётся эталонной реализацией для одного тикета
+    7. Разбор тикетов выполняется на event loop, в пуле потоков или в пуле процессов (create_executor)
+       частями по analysis_chunk тикетов, результат собирается и пишется в БД на event loop
     """
 
-    def __init__(self) -> None:
+    _stopped_columns = [column.name for column in StoppedTickets.__table__.columns]
+
+    def __init__(self, changes: ChangeTracker, executor: Executor = None, analysis_chunk: int = 250) -> None:
         self._database = engine_db
-        
+        self._changes = changes
+        self._executor = executor
+        self._analysis_chunk = analysis_chunk
+        self._engine = SlaEngine(comment_limit)
+        self._chunk = db_chunk
+        self._stopped_buffer = {}
+        self._stopped_seen = set()
+        self._expires_buffer = {}
+
     @staticmethod
     def analise(ticket: dict) -> str:
         def expires(task: dict, counter_sla: int, sla: int) -> int | str:
             group = 'SLA не превышен'
-            time_create = datetime.strptime(task['createTs'][0:19], format_date)
-            time_close = datetime.strptime(task['completionDate'][0:19], format_date)
+            time_create = timestamps.parse(task['createTs'])
+            time_close = timestamps.parse(task['completionDate'])
 
             time_work_on_request = (time_close - time_create).total_seconds() / 60
             counting_sla = counter_sla + time_work_on_request
@@ -35,35 +75,15 @@ class Analytics:
                 if not task.get('assignmentDate'):
                     time_assign = time_create
                 else:
-                    time_assign = datetime.strptime(task['assignmentDate'][0:19], format_date)
-
-                group = task['taskExecutorDTO']['execUnitName']
-
-                if task.get('taskComments') and len(task['taskComments'][-1]['comment']) > 0:
-                    end_comment = task['taskComments'][-1]['comment']
-                    parasitic_data = ("<p>", "</p>", "&nbsp;", "<br>", "<strong>",
-                                      "</strong>", "&gt;", "&lt;", "'")
+                    time_assign = timestamps.parse(task['assignmentDate'])
 
-                    refactor_comment = [end_comment.replace(old, ' ') for old in parasitic_data]
-
-                else:
-                    end_comment = "Комментарий отсутствует"
-
-                analise_info.update({'Результат': f"SLA превышен",
-                                     'Просрочено на группе': group,
-                                     'Номер запроса': task['taskNumber'],
-                                     'Время создания запроса': time_create.strftime(format_date),
-                                     'Время принятия в работу': time_assign.strftime(format_date),
-                                     'Время закрытия запроса': time_close.strftime(format_date),
-                                     'Время реакции': time_assign - time_create,
-                                     'Время решения': time_close - time_assign,
-                                     'Время всё': time_close - time_create,
-                                     'Последний комментарий (task)': end_comment})
-
-                if group == 'Вендор (ДЭФИР)' and task.get('foreignTicketId'):
-                    group = f"{task['providerName']}"
-                elif group == 'Провайдер' and task.get('foreignTicketId'):
-                    group = f"Провайдер ({task['providerName']})"
+                info, group = breach_info(task, (time_create.strftime(format_date),
+                                                 time_assign.strftime(format_date),
+                                                 time_close.strftime(format_date),
+                                                 time_assign - time_create,
+                                                 time_close - time_assign,
+                                                 time_close - time_create), comment_limit)
+                analise_info.update(info)
 
             return counting_sla, group
 
@@ -101,110 +121,215 @@ class Analytics:
         else:
             logger.info(f"В анализе найден неизвестный статус ТТ {ticket['id']} {ticket['status']}")
 
-        text = '\n'.join(map(lambda x: f"{x[0]}: {x[1]}", analise_info.items()))
-        return text, expire_group, close_date
+        return format_info(analise_info), expire_group, close_date
 
-    def stopped_report(self, stopped_tickets: list) -> list[dict]:
-        def time_format(date: datetime) -> str:
-            return str(datetime.strptime(date[0:19], "%Y-%m-%dT%H:%M:%S"))
+    @staticmethod
+    def _stopped_info(ticket: dict) -> dict | None:
+        ticket_sla = timestamps.parse(ticket['ola']['kdSLA'])
+        ticket_dump = ticket['tasks']
+
+        for task in reversed(ticket_dump):
+            if task['typeName'] == 'Ожидание':
+                index = ticket_dump.index(task)
+
+                author = ticket_dump[index - 1]['taskExecutorDTO']['executorName']
+                subdivision_requirement = ticket_dump[index - 2]['targetUnitName']
+                comment = clean_comment(ticket_dump[index - 1]['closeComment'], comment_limit)
+
+                return {
+                    "Номер запроса": task['taskNumber'],
+                    "Дата согласования приостановки": timestamps.parse(ticket_dump[index - 1]['createTs']),
+                    "Дата начала приостановки": timestamps.parse(task['createTs']),
+                    "Дата конца приостановки": timestamps.parse(task['suspendDate']),
+                    "Кто приостановил": author,
+                    "Последний коммент": comment,
+                    "Кто запросил приостановку": subdivision_requirement,
+                    "SLA (до которого)": ticket_sla
+                }
 
+    @staticmethod
+    def parse_stopped(tickets: list[dict], known: dict[int, str]) -> list[tuple]:
+        """
+        Разбирает пачку приостановленных тикетов без обращения к состоянию (может выполняться в другом процессе),
+        тикет, отпечаток которого совпал с известным (known), не разбирается
+        """
+        parsed = []
+        for ticket in tickets:
+            print_, ticket_info, error = None, None, None
+            try:
+                print_ = ChangeTracker.fingerprint([ticket['ola'], ticket['tasks']])
+                if known.get(ticket.get('id')) != print_:
+                    ticket_info = Analytics._stopped_info(ticket)
+            except (KeyError, IndexError, TypeError, ValueError) as err:
+                error = str(err)
+            parsed.append((ticket.get('id'), print_, ticket_info, error))
+        return parsed
+
+    async def run_analysis(self, function: Callable[..., list], items: list, *args) -> list:
+        analysis_tickets.inc(len(items), function=function.__name__)
+        with analysis_seconds.time(function=function.__name__):
+            if self._executor is None or not items:
+                return function(items, *args)
+
+            loop = asyncio.get_running_loop()
+            chunks = [items[i:i + self._analysis_chunk] for i in range(0, len(items), self._analysis_chunk)]
+            parts = await asyncio.gather(*(loop.run_in_executor(self._executor, function, chunk, *args)
+                                         for chunk in chunks))
+            return [item for part in parts for item in part]
+
+    async def stopped_report(self, stopped_tickets: list) -> list[dict]:
         try:
             result = []
-            for ticket in stopped_tickets:
-                logger.warning(f"Проверяю TT {ticket['id']}")
-                ticket_sla = time_format(ticket['ola']['kdSLA'])
-                ticket_dump = ticket['tasks']
-
-                for task in reversed(ticket_dump):
-                    if task['typeName'] == 'Ожидание':
-                        index = ticket_dump.index(task)
-
-                        author = ticket_dump[index - 1]['taskExecutorDTO']['executorName']
-                        subdivision_requirement = ticket_dump[index - 2]['targetUnitName']
-                        comment = re.sub(r'\<[^>]*\>', '', ticket_dump[index - 1]['closeComment'])
-
-                        ticket_info = {
-                            "Номер запроса": task['taskNumber'],
-                            "Дата согласования приостановки": time_format(ticket_dump[index - 1]['createTs']),
-                            "Дата начала приостановки": time_format(task['createTs']),
-                            "Дата конца приостановки": time_format(task['suspendDate']),
-                            "Кто приостановил": author,
-                            "Последний коммент": comment,
-                            "Кто запросил приостановку": subdivision_requirement,
-                            "SLA (до которого)": ticket_sla
-                        }
-                        result.append(ticket_info)
-                        break
-
-            with self._database.connect() as session:
-                request = select(StoppedTickets.task_number)
-                tickets_task = session.execute(request)
-                session.commit()
-                
-            tickets_id = [task[0] for task in tickets_task]
-
-            for ticket_data in result:
-                data = list(ticket_data.values())
-                ticket_id_num = data[0]
-                task_id = str(data[0]).split("-")[0]
-
-                if ticket_id_num in tickets_id:
-                    with self._database.connect() as session:
-                        request = update(StoppedTickets).where(StoppedTickets.task_number == task_id).values((*data,))
-                        session.execute(request)
-                        session.commit()
-
-                    logger.warning(f"Обновлён ТТ {ticket_id_num}")
-                else:
-                    with self._database.connect() as session:
-                        request = insert(StoppedTickets).values((*data,))
-                        session.execute(request)
-                        session.commit()
-
-                    logger.warning(f"Добавлен ТТ {ticket_id_num}")
+            known = self._changes.known([ticket.get('id') for ticket in stopped_tickets])
+            parsed = await self.run_analysis(self.parse_stopped, stopped_tickets, known)
+            for ticket_id, print_, ticket_info, error in parsed:
+                if print_ is not None and not self._changes.changed(ticket_id, print_):
+                    self._stopped_seen.update(self._changes.keys(ticket_id))
+                    continue
+
+                logger.warning(f"Проверяю TT {ticket_id}")
+                if error is not None:
+                    self._stopped_seen.update(self._changes.keys(ticket_id))
+                    logger.error(f"Не удалось разобрать приостановку TT {ticket_id}: {error}")
+                    continue
+
+                keys = []
+                if ticket_info is not None:
+                    row = dict(zip(self._stopped_columns, ticket_info.values()))
+                    self._stopped_buffer[row['task_number']] = row
+                    self._stopped_seen.add(row['task_number'])
+                    keys.append(row['task_number'])
+                    result.append(ticket_info)
+
+                self._changes.remember(ticket_id, print_, keys)
+
+            if len(self._stopped_buffer) >= self._chunk:
+                await self._write_stopped()
             return result
 
         except Exception as err:
             logger.error(f"Ошибка в отчёте приостановок: {err}", exc_info=True)
 
-    def arrears_report(self, arrears_tickets: list) -> list[dict]:
-        def time_formats(ticket_data: dict) -> datetime:
-            formate = '%Y-%m-%d'
-            now = datetime.now()
+    def unchanged_stopped(self, rows: dict[int, dict], skip: bool) -> set[int]:
+        unchanged = self._changes.unchanged_dashboard(rows, skip)
+        for ticket_id in unchanged:
+            self._stopped_seen.update(self._changes.keys(ticket_id))
+        return unchanged
+
+    async def _upsert(self, table: Table, key: str, rows: list[dict]) -> dict[str, int]:
+        counts = {'inserted': 0, 'updated': 0, 'skipped': 0}
+
+        for i in range(0, len(rows), self._chunk):
+            chunk = rows[i:i + self._chunk]
+            request = pg_insert(table).values(chunk)
+            fields = {column.name: request.excluded[column.name] for column in table.columns if column.name != key}
+            changed = or_(*(table.c[name].is_distinct_from(value) for name, value in fields.items()))
+            request = request.on_conflict_do_update(index_elements=[table.c[key]], set_=fields, where=changed)
+            request = request.returning(literal_column('xmax = 0').label('inserted'))
+
+            with db_write_seconds.time(table=table.name):
+                async with self._database.begin() as session:
+                    returned = (await session.execute(request)).scalars().all()
+
+            counts['inserted'] += sum(returned)
+            counts['updated'] += len(returned) - sum(returned)
+            counts['skipped'] += len(chunk) - len(returned)
+
+        for result, count in counts.items():
+            db_rows.inc(count, table=table.name, result=result)
+        return counts
+
+    async def _write_stopped(self) -> dict[str, int]:
+        rows = list(self._stopped_buffer.values())
+        self._stopped_buffer.clear()
+        try:
+            counts = await self._upsert(StoppedTickets.__table__, 'task_number', rows)
+        except Exception:
+            self._changes.reset()
+            raise
+
+        if rows:
+            logger.warning(f"Приостановки: {counts}")
+        return counts
+
+    async def flush_stopped(self, prune: bool = False, empty_dashboard: bool = False) -> dict[str, int]:
+        try:
+            counts = await self._write_stopped()
+            counts['deleted'] = 0
+
+            if prune and not self._stopped_seen and not empty_dashboard:
+                logger.error(f"Приостановки: ни одной строки не получено с непустого дашборда, очистка пропущена")
+            elif prune:
+                request = delete(StoppedTickets)
+                if self._stopped_seen:
+                    request = request.where(StoppedTickets.task_number.not_in(self._stopped_seen))
+                with db_write_seconds.time(table=StoppedTickets.__tablename__):
+                    async with self._database.begin() as session:
+                        counts['deleted'] = (await session.execute(request)).rowcount
+                db_rows.inc(counts['deleted'], table=StoppedTickets.__tablename__, result='deleted')
+                logger.warning(f"Приостановки: удалено покинувших дашборд {counts['deleted']}")
+            return counts
+
+        except Exception as err:
+            self._changes.reset()
+            logger.error(f"Ошибка записи приостановок: {err}", exc_info=True)
+        finally:
+            self._stopped_seen.clear()
 
-            date_y = datetime.strptime((now - timedelta(days=1)).strftime(formate), formate)
-            date_dby = datetime.strptime((now - timedelta(days=2)).strftime(formate), formate)
+    async def _write_expires(self) -> dict[str, int]:
+        rows = list(self._expires_buffer.values())
+        self._expires_buffer.clear()
+        counts = await self._upsert(ExpiresTickets.__table__, 'ticket_number', rows)
 
-            time_str = str(ticket_data['tasks'][-1]['completionDate']).split('T')[0]
-            date_close = datetime.strptime(time_str, formate)
-            return date_y, date_dby, date_close
+        if rows:
+            logger.warning(f"Просрочки: {counts}")
+        return counts
 
+    async def flush_expires(self) -> dict[str, int]:
         try:
-            result = []
+            return await self._write_expires()
+        except Exception as err:
+            logger.error(f"Ошибка записи просрочек: {err}", exc_info=True)
+
+    async def arrears_report(self, arrears_tickets: list, window: tuple[datetime, datetime] = None) -> list[dict]:
+        yesterday, db_yesterday = window or timestamps.day_window()
+
+        try:
+            result, candidates = [], []
             for ticket in arrears_tickets:
-                ticket_number = ticket['id']
-                logger.warning(f"Проверяю TT {ticket_number}")
+                logger.warning(f"Проверяю TT {ticket['id']}")
 
-                yesterday, db_yesterday, close = time_formats(ticket)
+                close = timestamps.parse_date(str(ticket['tasks'][-1]['completionDate']))
 
                 if yesterday >= close > db_yesterday:
-                    text, group, close_date = self.analise(ticket)
-    
-                    with self._database.connect() as session:
-                        request = insert(ExpiresTickets).values((ticket_number, group, text, close_date))
-                        session.execute(request)
-                        session.commit()
-
-                    result.append(
-                        {
-                        "ticket": ticket,
-                        "resp": group,
-                        "comment": text,
-                        "date": close_date
-                        }
-                    )
+                    candidates.append(ticket)
                 else:
                     result.append({"ticket": ticket, "comment": "eliminated"})
+
+            for ticket, analysis in zip(candidates, await self.run_analysis(self._engine.analise, candidates)):
+                ticket_number = ticket['id']
+                if analysis is None:
+                    logger.error(f"Не удалось проанализировать TT {ticket_number}")
+                    continue
+
+                text, group, close_date = analysis
+                self._expires_buffer[ticket_number] = {
+                    'ticket_number': ticket_number,
+                    'responsible': group,
+                    'comment': text,
+                    'add_date': timestamps.parse_date(close_date) if close_date[:1].isdigit() else None
+                }
+                result.append(
+                    {
+                    "ticket": ticket,
+                    "resp": group,
+                    "comment": text,
+                    "date": close_date
+                    }
+                )
+
+            if len(self._expires_buffer) >= self._chunk:
+                await self._write_expires()
             return result
 
         except Exception as err:
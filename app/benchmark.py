@@ -0,0 +1,136 @@
+"""
+Замеры производительности анализа тикетов на синтетических данных.
+Запуск из директории ./app (нужен файл .env, подключение к БД не требуется): python3 benchmark.py [количество тикетов]
+"""
+import asyncio
+import os
+import random
+import re
+import sys
+import time
+from datetime import datetime, timedelta
+from analytics import Analytics, create_executor
+from changes import ChangeTracker
+from sla import SlaEngine
+from comments import clean_comment
+from database import comment_limit
+
+
+def make_ticket(number: int, rnd: random.Random) -> dict:
+    start = datetime(2023, 5, 1) + timedelta(minutes=rnd.randint(0, 60 * 24 * 30))
+    types = ('Решение', 'Ожидание', 'Запрос клиента', 'Согласование')
+    units = ('Группа А', 'Решение сетевого ТТ', 'Решение базового ТТ', 'Провайдер', 'Вендор (ДЭФИР)')
+    tasks = []
+
+    for index in range(rnd.randint(1, 12)):
+        created = start + timedelta(minutes=rnd.randint(0, 600))
+        completed = created + timedelta(minutes=rnd.randint(1, 600))
+        tasks.append({
+            'taskNumber': f'{number}-{index + 1}',
+            'typeName': rnd.choice(types),
+            'createTs': created.strftime('%Y-%m-%dT%H:%M:%S.000+0300'),
+            'completionDate': completed.strftime('%Y-%m-%dT%H:%M:%S.000+0300'),
+            'assignmentDate': rnd.choice([None, (created + timedelta(minutes=5)).strftime('%Y-%m-%dT%H:%M:%S')]),
+            'taskExecutorDTO': {'execUnitName': rnd.choice(units), 'executorName': 'Иванов И.И.'},
+            'taskComments': [{'comment': rnd.choice(['', '<p>Работы&nbsp;выполнены</p>', 'ok'])}],
+            'foreignTicketId': rnd.choice([None, 'EXT-1']),
+            'providerName': 'ООО Связь',
+        })
+        start = completed
+
+    if rnd.random() < 0.05:
+        del rnd.choice(tasks)[rnd.choice(('typeName', 'taskExecutorDTO', 'createTs', 'taskNumber'))]
+
+    return {'id': number, 'status': 'Закрыт', 'closeDate': start.strftime('%Y-%m-%dT%H:%M:%S'),
+            'ola': {'ksSla': str(rnd.choice([60, 240, 480]))}, 'tasks': tasks}
+
+
+def reference(ticket: dict) -> tuple[str, str, str] | None:
+    try:
+        return Analytics.analise(ticket)
+    except Exception:
+        return None
+
+
+def measure(title: str, function, *args) -> tuple[float, object]:
+    started = time.perf_counter()
+    result = function(*args)
+    elapsed = time.perf_counter() - started
+    print(f"{title:<40} {elapsed:8.3f} s")
+    return elapsed, result
+
+
+def bench_sla(tickets: list[dict]) -> None:
+    print(f"SLA: {len(tickets)} тикетов")
+    scalar, expected = measure("Analytics.analise (по одному)", lambda: [reference(ticket) for ticket in tickets])
+    batch, result = measure("SlaEngine.analise (пачкой)", SlaEngine(comment_limit).analise, tickets)
+
+    assert result == expected, "результаты SlaEngine расходятся с Analytics.analise"
+    print(f"{'ускорение':<40} {scalar / batch:8.1f} x")
+
+
+def legacy_comment(comment: str) -> str:
+    for old in ("<p>", "</p>", "&nbsp;", "<br>", "<strong>", "</strong>", "&gt;", "&lt;", "'"):
+        comment = comment.replace(old, ' ')
+    return re.sub(r'\<[^>]*\>', '', comment)
+
+
+def bench_comments(count: int) -> None:
+    rnd = random.Random(0)
+    words = ('Работы', 'выполнены', 'ожидаем', 'ответа', 'провайдера', 'канал', 'восстановлен', 'авария', 'на', 'узле')
+    markup = ('<p>', '</p>', '&nbsp;', '<br>', '<strong>', '</strong>', '&gt;', '&lt;', "'")
+    comments = [' '.join(rnd.choice(markup) if rnd.random() < 0.1 else rnd.choice(words)
+                         for _ in range(rnd.randint(5, 200))) for _ in range(count)]
+
+    print(f"Комментарии: {count} шт.")
+    legacy, _ = measure("str.replace + re.sub (было)", lambda: [legacy_comment(item) for item in comments])
+    single, _ = measure("clean_comment (один проход)", lambda: [clean_comment(item, comment_limit) for item in comments])
+    print(f"{'ускорение':<40} {legacy / single:8.1f} x")
+
+
+async def run_mode(analyst: Analytics, engine: SlaEngine, tickets: list[dict]) -> tuple[float, float, list]:
+    await analyst.run_analysis(engine.analise, tickets[:1])
+    lag = 0.0
+
+    async def ticker() -> None:
+        nonlocal lag
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + 0.005
+            await asyncio.sleep(0.005)
+            lag = max(lag, loop.time() - expected)
+
+    watcher = asyncio.create_task(ticker())
+    await asyncio.sleep(0.01)
+    started = time.perf_counter()
+    result = await analyst.run_analysis(engine.analise, tickets)
+    elapsed = time.perf_counter() - started
+    await asyncio.sleep(0.01)
+    watcher.cancel()
+    return elapsed, lag, result
+
+
+def bench_modes(tickets: list[dict], workers: int, chunk: int) -> None:
+    print(f"Режимы анализа: {len(tickets)} тикетов, {workers} воркеров, пачка {chunk}")
+    engine = SlaEngine(comment_limit)
+    expected = engine.analise(tickets)
+
+    for mode in ('inline', 'thread', 'process'):
+        executor = create_executor(mode, workers)
+        try:
+            analyst = Analytics(ChangeTracker(0), executor, chunk)
+            elapsed, lag, result = asyncio.run(run_mode(analyst, engine, tickets))
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+        assert result == expected, f"результаты режима {mode} расходятся с SlaEngine.analise"
+        print(f"{mode:<40} {elapsed:8.3f} s   задержка event loop {lag * 1000:7.1f} ms")
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    sample = [make_ticket(number, random.Random(number)) for number in range(count)]
+    bench_sla(sample)
+    bench_comments(count)
+    bench_modes(sample, os.cpu_count() or 1, 250)
@@ -0,0 +1,150 @@
+import asyncio
+import json
+import shelve
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Awaitable
+
+
+class TicketCache:
+    """
+    Класс кеша тикетов между TaskManager и коннектором:
+    1. В памяти хранится не более size тикетов, при переполнении вытесняется давно не использованный (LRU)
+    2. Тикет живёт ttl секунд, закрытый тикет (не меняется) - closed_ttl секунд
+    3. Закрытые тикеты дополнительно сохраняются на диск (shelve), если задан путь:
+       чтение и запись идут пачкой в отдельном потоке, не блокируя event loop
+    4. Одновременные запросы одного тикета ждут один общий запрос к коннектору
+    """
+
+    def __init__(self, size: int, ttl: int, closed_ttl: int, path: str = None) -> None:
+        self._size = size
+        self._ttl = ttl
+        self._closed_ttl = closed_ttl
+        self._items = OrderedDict()
+        self._flights = {}
+        self._unsaved = {}
+        self._memory = 0
+        self._stats = {'hits': 0, 'misses': 0, 'disk_hits': 0, 'evictions': 0}
+        self._disk = shelve.open(path) if path else None
+        self._disk_io = ThreadPoolExecutor(max_workers=1, thread_name_prefix='cache-disk') if path else None
+
+    def get(self, key: str, closed_only: bool = False) -> dict | None:
+        item = self._items.get(key)
+        if item is None:
+            return None
+
+        expires, size, ticket = item
+        if expires <= time.time():
+            self._drop(key)
+            return None
+        if closed_only and ticket.get('status') != 'Закрыт':
+            return None
+        self._items.move_to_end(key)
+        self._stats['hits'] += 1
+        return ticket
+
+    def put(self, key: str, ticket: dict) -> None:
+        closed = ticket.get('status') == 'Закрыт'
+        expires = time.time() + (self._closed_ttl if closed else self._ttl)
+        self._store(key, expires, ticket)
+
+        if closed and self._disk is not None:
+            self._unsaved[key] = (expires, ticket)
+
+    def _store(self, key: str, expires: float, ticket: dict) -> None:
+        if key in self._items:
+            self._drop(key)
+
+        size = len(json.dumps(ticket, ensure_ascii=False, default=str))
+        self._items[key] = (expires, size, ticket)
+        self._memory += size
+
+        while len(self._items) > self._size:
+            self._drop(next(iter(self._items)))
+            self._stats['evictions'] += 1
+
+    def _drop(self, key: str) -> None:
+        _, size, _ = self._items.pop(key)
+        self._memory -= size
+
+    def _read_disk(self, keys: list[str]) -> dict[str, tuple]:
+        found, now = {}, time.time()
+        for key in keys:
+            if key in self._disk:
+                expires, ticket = self._disk[key]
+                if expires > now:
+                    found[key] = (expires, ticket)
+                else:
+                    del self._disk[key]
+        return found
+
+    def _write_disk(self, items: dict[str, tuple]) -> None:
+        for key, item in items.items():
+            self._disk[key] = item
+        self._disk.sync()
+
+    async def _load(self, keys: list[str]) -> dict[str, dict]:
+        if self._disk is None or not keys:
+            return {}
+
+        stored = await asyncio.get_running_loop().run_in_executor(self._disk_io, self._read_disk, keys)
+        for key, (expires, ticket) in stored.items():
+            self._store(key, expires, ticket)
+        self._stats['disk_hits'] += len(stored)
+        return {key: ticket for key, (_, ticket) in stored.items()}
+
+    async def _save(self) -> None:
+        if not self._unsaved:
+            return
+
+        items, self._unsaved = self._unsaved, {}
+        await asyncio.get_running_loop().run_in_executor(self._disk_io, self._write_disk, items)
+
+    async def get_many(self, keys: list, loader: Callable[[list], Awaitable[dict[str, dict]]],
+                       closed_only: bool = False) -> list[dict]:
+        """
+        Возвращает тикеты из кеша, недостающие запрашивает через loader одним вызовом.
+        closed_only - из кеша берутся только закрытые тикеты, открытые запрашиваются заново
+        """
+        found, waits, missing = {}, {}, []
+        for key in dict.fromkeys(map(str, keys)):
+            ticket = self.get(key, closed_only)
+            if ticket is not None:
+                found[key] = ticket
+            elif key in self._flights:
+                waits[key] = self._flights[key]
+            else:
+                missing.append(key)
+
+        if missing:
+            loop = asyncio.get_running_loop()
+            flights = {key: loop.create_future() for key in missing}
+            self._flights.update(flights)
+            loaded = {}
+            try:
+                loaded = await self._load(missing)
+                missing = [key for key in missing if key not in loaded]
+                self._stats['misses'] += len(missing)
+                if missing:
+                    fetched = await loader(missing)
+                    for key, ticket in fetched.items():
+                        self.put(key, ticket)
+                    loaded.update(fetched)
+                found.update(loaded)
+            finally:
+                for key, future in flights.items():
+                    self._flights.pop(key, None)
+                    if not future.done():
+                        future.set_result(loaded.get(key))
+            await self._save()
+
+        for key, future in waits.items():
+            ticket = await asyncio.shield(future)
+            if ticket is not None:
+                found[key] = ticket
+
+        return [found[key] for key in map(str, keys) if key in found]
+
+    def stats(self) -> dict[str, int]:
+        return dict(self._stats, size=len(self._items), memory=self._memory, in_flight=len(self._flights))
@@ -0,0 +1,56 @@
+import hashlib
+import json
+import time
+
+
+class ChangeTracker:
+    """
+    Класс для отслеживания изменений тикетов между циклами опроса:
+    1. Для каждого тикета хранится отпечаток (хеш) списка его задач и ключи записанных по нему строк БД
+    2. Неизменившийся тикет не разбирается повторно и не перезаписывается в БД
+    3. Для строк дашборда хранится свой отпечаток, по нему можно не запрашивать тикет вовсе
+    4. Не реже чем раз в full_refresh секунд выполняется полный цикл без пропусков
+    """
+
+    def __init__(self, full_refresh: int) -> None:
+        self._tickets = {}
+        self._keys = {}
+        self._dashboard = {}
+        self._full_refresh = full_refresh
+        self._last_full = 0.0
+
+    @staticmethod
+    def fingerprint(data: dict | list) -> str:
+        dump = json.dumps(data, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.blake2b(dump.encode('utf-8'), digest_size=16).hexdigest()
+
+    def changed(self, ticket_id: int, print_: str) -> bool:
+        return self._tickets.get(ticket_id) != print_
+
+    def known(self, ticket_ids: list[int]) -> dict[int, str]:
+        return {ticket_id: self._tickets[ticket_id] for ticket_id in ticket_ids if ticket_id in self._tickets}
+
+    def remember(self, ticket_id: int, print_: str, keys: list[str]) -> None:
+        self._tickets[ticket_id] = print_
+        self._keys[ticket_id] = keys
+
+    def keys(self, ticket_id: int) -> list[str]:
+        return self._keys.get(ticket_id, [])
+
+    def unchanged_dashboard(self, rows: dict[int, dict], skip: bool) -> set[int]:
+        for ticket_id in set(self._tickets) - set(rows):
+            self._tickets.pop(ticket_id, None)
+            self._keys.pop(ticket_id, None)
+
+        previous, self._dashboard = self._dashboard, {ticket_id: self.fingerprint(row) for ticket_id, row in rows.items()}
+        if not skip or time.monotonic() - self._last_full >= self._full_refresh:
+            self._last_full = time.monotonic()
+            return set()
+
+        return {ticket_id for ticket_id, print_ in self._dashboard.items()
+                if previous.get(ticket_id) == print_ and ticket_id in self._tickets}
+
+    def reset(self) -> None:
+        self._tickets.clear()
+        self._keys.clear()
+        self._dashboard.clear()
@@ -0,0 +1,19 @@
+import html
+import re
+
+
+_tags = re.compile(r'<[^>]*>')
+
+
+def clean_comment(comment: str, limit: int) -> str:
+    """
+    Убирает из комментария NTTM html-теги (заменяет пробелом) и сущности (&nbsp; - обычный пробел, как раньше),
+    обрезает до limit символов
+    """
+    text = _tags.sub(' ', comment)
+    if '&' in text:
+        text = html.unescape(text).replace('\xa0', ' ')
+    text = text.strip()
+    if len(text) > limit:
+        text = text[:limit - 1] + '…'
+    return text
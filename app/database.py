@@ -1,6 +1,6 @@
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import Column, Integer, String, DateTime 
-from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import create_async_engine
 from datetime import datetime
 from envparse import Env
 
@@ -9,6 +9,12 @@ env = Env()
 env.read_envfile('.env')
 
 db_path = env.str("DB_PATH")
+db_chunk = env.int("DB_CHUNK", default=500)
+db_pool_size = env.int("DB_POOL_SIZE", default=5)
+db_max_overflow = env.int("DB_MAX_OVERFLOW", default=10)
+db_pre_ping = env.bool("DB_PRE_PING", default=True)
+db_statement_timeout = env.float("DB_STATEMENT_TIMEOUT", default=60)
+comment_limit = env.int("COMMENT_LIMIT", default=1000)
 
 
 Base = declarative_base()
@@ -35,5 +41,15 @@ class StoppedTickets(Base):
     sla = Column(DateTime, default=datetime.utcnow)
 
 
-engine_db = create_engine(db_path)
-Base.metadata.create_all(engine_db)
+engine_db = create_async_engine(
+    db_path.replace('postgresql://', 'postgresql+asyncpg://', 1),
+    pool_size=db_pool_size,
+    max_overflow=db_max_overflow,
+    pool_pre_ping=db_pre_ping,
+    connect_args={'server_settings': {'statement_timeout': str(int(db_statement_timeout * 1000))}}
+)
+
+
+async def init_db() -> None:
+    async with engine_db.begin() as connection:
+        await connection.run_sync(Base.metadata.create_all)
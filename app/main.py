@@ -1,11 +1,18 @@
 import asyncio
-from datetime import datetime
-from datetime import timedelta
+import itertools
+import os
+from datetime import date
 from envparse import Env
 from log import logger
-from typing import Awaitable
+from typing import Awaitable, AsyncIterator
 from ws_server import ServerServices
-from analytics import Analytics
+from analytics import Analytics, create_executor
+from database import init_db
+from changes import ChangeTracker
+from cache import TicketCache
+from scheduler import Scheduler, CronTrigger, IntervalTrigger
+import timestamps
+import metrics
 
 
 env = Env()
@@ -15,6 +22,23 @@ port = env("PORT")
 interval = env.int("INTERVAL")
 stopped_filter = env.str("FILTER_STOPPED")
 arrears_filter = env.str("FILTER_ARREARS")
+window = env.int("CONCURRENCY", default=50)
+batch_size = env.int("BATCH_SIZE", default=20)
+dashboard_skip = env.bool("DASHBOARD_SKIP", default=False)
+full_refresh = env.int("FULL_REFRESH", default=3600)
+cache_size = env.int("CACHE_SIZE", default=5000)
+cache_ttl = env.int("CACHE_TTL", default=120)
+cache_closed_ttl = env.int("CACHE_CLOSED_TTL", default=86400)
+cache_path = env.str("CACHE_PATH", default="")
+analysis_batch = env.int("ANALYSIS_BATCH", default=500)
+analysis_mode = env.str("ANALYSIS_MODE", default="thread")
+analysis_workers = env.int("ANALYSIS_WORKERS", default=os.cpu_count() or 1)
+analysis_chunk = env.int("ANALYSIS_CHUNK", default=250)
+arrears_cron = env.str("ARREARS_CRON", default="*/5 0-2 * * *")
+misfire_grace = env.float("MISFIRE_GRACE", default=60)
+job_jitter = env.float("JOB_JITTER", default=0)
+job_retry = env.float("JOB_RETRY", default=1)
+metrics_port = env.int("METRICS_PORT", default=9100)
 
 
 class TaskManager:
@@ -22,14 +46,18 @@ class TaskManager:
     Класс для менеджмента клиент-серверных задач (получение дашборда/тикета):
     1. Класс обращается к методам класса ServerServices для создания заданий
     2. Класс ServerServices создаёт задания для подключенных клиентов и отправляет их
-    3. Получая в ответе информацию по тикету, вызывается нужный метод из класса Analytics
+    3. Тикеты запрашиваются пачками (get_incs) окном ограниченного размера и отдаются пачками по мере получения
+       (полученные тикеты кешируются в TicketCache)
+    4. Получая в ответе информацию по тикету, вызывается нужный метод из класса Analytics
     """
 
-    def __init__(self, stopped: str, arrears: str) -> None:
-        self._arrears_tickets = []
-        self._stopped_tickets = []
+    def __init__(self, stopped: str, arrears: str, window: int, batch: int, cache: TicketCache) -> None:
         self._stopped_filter = stopped
         self._arrears_filter = arrears
+        self._window = window
+        self._batch = batch
+        self._cache = cache
+        self.dashboard_rows = {}
 
     async def get_dashboard(self, services: ServerServices, key_filter: str) -> list[int]:
         incidents = []
@@ -38,83 +66,176 @@ class TaskManager:
 
         if key_filter == self._stopped_filter:
             identify = "ticketId"
-            self._stopped_tickets.clear()
         else:
             identify = "id"
-            self._arrears_tickets.clear()
 
         if response['status_code'] == 200:
             result = response['result']
+            if key_filter == self._stopped_filter:
+                self.dashboard_rows = {ticket[identify]: ticket for ticket in result}
             for ticket in result:
                 incidents.append(ticket[identify])
             return incidents
         else:
             logger.error(f'Не удалось получить дашборд: {response}', exc_info=True)
 
-    async def get_ticket(self, services: ServerServices, ticket: int, key: str) -> dict[str, dict]:
+    async def _fetch_ticket(self, services: ServerServices, ticket: int | str) -> dict[str, dict]:
         logger.warning(f"Запрос данных по TT {ticket}")
         response = await services.nttm.get_inc(ticket)
 
         if response['status_code'] == 200:
-            result = response['result']
-            if key == self._stopped_filter:
-                self._stopped_tickets.append(result)
-                return result
+            return {str(ticket): response['result']}
+        return {}
+
+    async def _fetch_tickets(self, services: ServerServices, tickets: list[str]) -> dict[str, dict]:
+        logger.warning(f"Запрос данных по TT {tickets[0]}..{tickets[-1]} ({len(tickets)} шт.)")
+        response = await services.nttm.get_incs(tickets)
+
+        if response['status_code'] is None:
+            results = {}
+            for result in await asyncio.gather(*(self._fetch_ticket(services, ticket) for ticket in tickets)):
+                results.update(result)
+            return results
+
+        if response['status_code'] != 200:
+            logger.error(f"Не удалось получить пачку TT: {response}")
+            return {}
+
+        results = {}
+        for item in response['result']:
+            if item['status_code'] == 200:
+                results[item['inc']] = item['result']
             else:
-                self._arrears_tickets.append(result)
-                return result
-
-    async def task_creator(self, service: ServerServices, tickets: list, key: str) -> list[dict]:
-        tasks = []
-        for ticket in tickets:
-            task = asyncio.create_task(self.get_ticket(service, ticket, key))
-            tasks.append(task)
-        await asyncio.gather(*tasks)
-
-        if key == self._stopped_filter:
-            if self._stopped_tickets:
-                return self._stopped_tickets
-            logger.error(f"Ошибка с приостановками", exc_info=True)
-        else:
-            if self._arrears_tickets:
-                return self._arrears_tickets
-            logger.error(f"Ошибка с просрочками", exc_info=True)
+                logger.error(f"Не удалось получить TT {item['inc']}: {item['result']}")
+        return results
+
+    async def get_ticket(self, services: ServerServices, ticket: int) -> dict[str, dict]:
+        result = await self._cache.get_many([ticket], lambda keys: self._fetch_ticket(services, keys[0]))
+        if result:
+            return result[0]
+
+    async def get_tickets(self, services: ServerServices, tickets: list[int], fresh: bool = False) -> list[dict]:
+        return await self._cache.get_many(tickets, lambda keys: self._fetch_tickets(services, keys), closed_only=fresh)
+
+    async def task_creator(self, service: ServerServices, tickets: list,
+                           fresh: bool = False) -> AsyncIterator[list[dict]]:
+        batches = (tickets[i:i + self._batch] for i in range(0, len(tickets), self._batch))
+        pending = {asyncio.create_task(self.get_tickets(service, batch, fresh))
+                   for batch in itertools.islice(batches, self._window)}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                pending.update(asyncio.create_task(self.get_tickets(service, batch, fresh))
+                               for batch in itertools.islice(batches, len(done)))
+
+                for task in done:
+                    if task.result():
+                        yield task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+
+def register_metrics(service: ServerServices, cache: TicketCache, scheduler: Scheduler) -> None:
+    registry = metrics.registry
+    registry.collect('analytics_tasks', 'Задания коннектору: ожидают ответа, у коннектора, в очередях, кредиты',
+                     lambda: {state: value for state, value in service.nttm.stats().items() if state != 'rejected_replies'},
+                     ('state',))
+    registry.collect('analytics_rejected_replies_total', 'Ответы на неизвестные или устаревшие задания',
+                     lambda: service.nttm.stats()['rejected_replies'], kind='counter')
+    registry.collect('analytics_clients', 'Подключенные коннекторы', lambda: len(service.nttm.clients))
+    registry.collect('analytics_cache_events_total', 'События кеша тикетов',
+                     lambda: {event: value for event, value in cache.stats().items()
+                              if event in ('hits', 'misses', 'disk_hits', 'evictions')}, ('event',), kind='counter')
+    registry.collect('analytics_cache', 'Состояние кеша тикетов (size, memory, in_flight)',
+                     lambda: {field: value for field, value in cache.stats().items()
+                              if field in ('size', 'memory', 'in_flight')}, ('field',))
+    registry.collect('analytics_timestamp_cache_events_total', 'Попадания и промахи кеша разбора меток времени',
+                     lambda: {(function, event): info[event] for function, info in timestamps.cache_stats().items()
+                              for event in ('hits', 'misses')}, ('function', 'event'), kind='counter')
+    registry.collect('analytics_timestamp_cache_size', 'Размер кеша разбора меток времени',
+                     lambda: {function: info['currsize'] for function, info in timestamps.cache_stats().items()},
+                     ('function',))
+    registry.collect('analytics_job_events_total', 'Запуски, ошибки, наложения и пропуски заданий планировщика',
+                     lambda: {(job, event): value for job, stats in scheduler.stats().items()
+                              for event, value in stats.items() if event in ('runs', 'failures', 'overlaps', 'misfires')},
+                     ('job', 'event'), kind='counter')
+    registry.collect('analytics_job_running', 'Выполняется ли задание планировщика',
+                     lambda: {job: stats['running'] for job, stats in scheduler.stats().items()}, ('job',))
+    registry.collect('analytics_job_last_duration_seconds', 'Длительность последнего запуска задания',
+                     lambda: {job: stats['duration'] for job, stats in scheduler.stats().items()}, ('job',))
 
 
 async def core() -> Awaitable:
-    manager = TaskManager(stopped_filter, arrears_filter)
+    cache = TicketCache(cache_size, cache_ttl, cache_closed_ttl, cache_path or None)
+    manager = TaskManager(stopped_filter, arrears_filter, window, batch_size, cache)
     service = ServerServices(port)
-    analyst = Analytics()
+    analyst = Analytics(ChangeTracker(full_refresh), create_executor(analysis_mode, analysis_workers), analysis_chunk)
+    scheduler = Scheduler(misfire_grace, job_jitter)
+    await init_db()
+    await service.create_server()
+    await metrics.serve(metrics_port)
+    register_metrics(service, cache, scheduler)
+
+    arrears_done = None
+
+    async def arrears() -> bool:
+        nonlocal arrears_done
+        if arrears_done == date.today():
+            return True
+        if not service.nttm.check_client():
+            return False
+
+        tickets = await manager.get_dashboard(service, arrears_filter)
+        if not tickets:
+            return False
+
+        expires, batch = 0, []
+        window = timestamps.day_window()
+        async for result in manager.task_creator(service, tickets):
+            batch.extend(result)
+            if len(batch) >= analysis_batch:
+                expires += len(await analyst.arrears_report(batch, window) or [])
+                batch = []
+        expires += len(await analyst.arrears_report(batch, window) or [])
+        if await analyst.flush_expires() is None:
+            return False
+
+        if expires and len(tickets) == expires:
+            arrears_done = date.today()
+        elif not expires:
+            logger.error(f"Ошибка с просрочками")
+        return True
+
+    async def stopped() -> bool:
+        if not service.nttm.check_client():
+            return False
+
+        tickets = await manager.get_dashboard(service, stopped_filter)
+        if tickets is None:
+            return False
+        if not tickets:
+            await analyst.flush_stopped(prune=True, empty_dashboard=True)
+            return True
+
+        unchanged = analyst.unchanged_stopped(manager.dashboard_rows, dashboard_skip)
+        changed = [ticket for ticket in tickets if ticket not in unchanged]
+
+        fetched, failed = 0, False
+        async for result in manager.task_creator(service, changed, fresh=True):
+            if await analyst.stopped_report(result) is None:
+                failed = True
+            else:
+                fetched += len(result)
+        await analyst.flush_stopped(prune=not failed and fetched == len(changed))
 
-    successfully = False
-    date_event = datetime.now() - timedelta(seconds=1)
-    
-    while True:
-        try:
-            now = datetime.now()
-            
-            if now.hour < 3 and not successfully:
-                if service.nttm.check_client():
-                    tickets = await manager.get_dashboard(service, arrears_filter)
-                    if tickets:
-                        result = await manager.task_creator(service, tickets, arrears_filter)
-                        expires = analyst.arrears_report(result)
-                        if expires and len(tickets) == len(expires):
-                            successfully = True
-            if now.hour > 3:
-                successfully = False
-
-            if now > date_event:
-                if service.nttm.check_client():
-                    tickets = await manager.get_dashboard(service, stopped_filter)
-                    if tickets:
-                        result = await manager.task_creator(service, tickets, stopped_filter)
-                        analyst.stopped_report(result)
-                        date_event = now + timedelta(seconds=interval)
-
-        except Exception as error:
-            logger.error(f'Ошибка в core: {error}', exc_info=True)
-        await asyncio.sleep(1)
+        if changed and not fetched:
+            logger.error(f"Ошибка с приостановками")
+        return True
+
+    scheduler.add_job('arrears', arrears, CronTrigger(arrears_cron))
+    scheduler.add_job('stopped', stopped, IntervalTrigger(interval), immediately=True, retry=job_retry)
+    await scheduler.run()
 
 
 if __name__ == '__main__':
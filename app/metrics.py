@@ -0,0 +1,161 @@
+import math
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterator
+from aiohttp import web
+
+
+buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _labels(names: tuple, values: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Монотонно растущий счётчик с метками"""
+
+    kind = 'counter'
+
+    def __init__(self, name: str, help_: str, labels: tuple = ()) -> None:
+        self.name = name
+        self.help = help_
+        self._names = tuple(labels)
+        self._values = {}
+
+    def inc(self, value: float = 1, **labels) -> None:
+        key = tuple(str(labels[name]) for name in self._names)
+        self._values[key] = self._values.get(key, 0) + value
+
+    def lines(self) -> Iterator[str]:
+        for key, value in self._values.items():
+            yield f'{self.name}{_labels(self._names, key)} {_number(value)}'
+
+
+class Histogram:
+    """Гистограмма длительностей (секунды) с метками и кумулятивными корзинами"""
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, help_: str, labels: tuple = (), bounds: tuple = buckets) -> None:
+        self.name = name
+        self.help = help_
+        self._names = tuple(labels)
+        self._bounds = tuple(bounds) + (math.inf,)
+        self._values = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(str(labels[name]) for name in self._names)
+        counts, total = self._values.get(key, ([0] * len(self._bounds), 0.0))
+        for index, bound in enumerate(self._bounds):
+            if value <= bound:
+                counts[index] += 1
+        self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def lines(self) -> Iterator[str]:
+        for key, (counts, total) in self._values.items():
+            for bound, count in zip(self._bounds, counts):
+                le = 'le="' + _number(bound) + '"'
+                yield f'{self.name}_bucket{_labels(self._names, key, le)} {count}'
+            yield f'{self.name}_sum{_labels(self._names, key)} {_number(total)}'
+            yield f'{self.name}_count{_labels(self._names, key)} {counts[-1]}'
+
+
+class Collector:
+    """
+    Метрика, значения которой читаются при каждом запросе из функции (например, из методов stats()):
+    функция возвращает число или словарь {значение метки (или кортеж значений): число}
+    """
+
+    def __init__(self, name: str, help_: str, labels: tuple, function: Callable, kind: str) -> None:
+        self.name = name
+        self.help = help_
+        self.kind = kind
+        self._names = tuple(labels)
+        self._function = function
+
+    def lines(self) -> Iterator[str]:
+        values = self._function()
+        if not isinstance(values, dict):
+            values = {(): values}
+
+        for key, value in values.items():
+            if isinstance(value, bool):
+                value = int(value)
+            if isinstance(value, (int, float)):
+                key = key if isinstance(key, tuple) else (key,)
+                yield f'{self.name}{_labels(self._names, key)} {_number(value)}'
+
+
+class Registry:
+    """
+    Реестр метрик в текстовом формате Prometheus:
+    1. Счётчики и гистограммы обновляются в местах измерения
+    2. Снимки состояния (очереди, кеш, пулы) читаются из stats() в момент запроса /metrics
+    3. Повторная регистрация метрики с тем же именем заменяет прежнюю (например, после переподключения)
+    """
+
+    def __init__(self) -> None:
+        self._metrics = {}
+
+    def counter(self, name: str, help_: str, labels: tuple = ()) -> Counter:
+        return self._metrics.setdefault(name, Counter(name, help_, labels))
+
+    def histogram(self, name: str, help_: str, labels: tuple = (), bounds: tuple = buckets) -> Histogram:
+        return self._metrics.setdefault(name, Histogram(name, help_, labels, bounds))
+
+    def collect(self, name: str, help_: str, function: Callable, labels: tuple = (), kind: str = 'gauge') -> None:
+        self._metrics[name] = Collector(name, help_, labels, function, kind)
+
+    def render(self) -> str:
+        output = []
+        for metric in self._metrics.values():
+            try:
+                lines = list(metric.lines())
+            except Exception as error:
+                output.append(f'# {metric.name}: {error}')
+                continue
+            output.append(f'# HELP {metric.name} {metric.help}')
+            output.append(f'# TYPE {metric.name} {metric.kind}')
+            output.extend(lines)
+        return '\n'.join(output) + '\n'
+
+
+registry = Registry()
+
+
+async def serve(port: int) -> web.AppRunner | None:
+    """Поднимает HTTP эндпоинт /metrics на текущем event loop, port 0 - не поднимать"""
+    if not port:
+        return None
+
+    async def handler(_: web.Request) -> web.Response:
+        return web.Response(text=registry.render(), content_type='text/plain', charset='utf-8')
+
+    application = web.Application()
+    application.router.add_get('/metrics', handler)
+    runner = web.AppRunner(application, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, port=port).start()
+    return runner
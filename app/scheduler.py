@@ -0,0 +1,205 @@
+import asyncio
+import random
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Awaitable
+from log import logger
+import metrics
+
+
+job_seconds = metrics.registry.histogram('analytics_job_seconds', 'Длительность запуска задания планировщика',
+                                         ('job', 'outcome'))
+
+
+class IntervalTrigger:
+    """Запуск через фиксированный интервал (в секундах) от начала предыдущего запуска"""
+
+    def __init__(self, seconds: float) -> None:
+        self._interval = timedelta(seconds=seconds)
+
+    def next_after(self, moment: datetime) -> datetime:
+        return moment + self._interval
+
+
+class CronTrigger:
+    """
+    Запуск по расписанию в формате cron из пяти полей (минута, час, день месяца, месяц, день недели):
+    поддерживаются *, списки через запятую, диапазоны a-b и шаг /n, день недели 0 (или 7) - воскресенье
+    """
+
+    _bounds = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, spec: str) -> None:
+        fields = spec.split()
+        if len(fields) != 5:
+            raise ValueError(f"Ожидается 5 полей cron, получено: {spec!r}")
+
+        self._spec = spec
+        self._minutes, self._hours, self._days, self._months, weekdays = (
+            self._parse(field, low, high) for field, (low, high) in zip(fields, self._bounds))
+        self._weekdays = {day % 7 for day in weekdays}
+        self._any_day, self._any_weekday = fields[2] == '*', fields[4] == '*'
+
+    @staticmethod
+    def _parse(field: str, low: int, high: int) -> set[int]:
+        values = set()
+        for part in field.split(','):
+            body, _, step = part.partition('/')
+            if body == '*':
+                start, stop = low, high
+            elif '-' in body:
+                start, stop = map(int, body.split('-', 1))
+            else:
+                start = int(body)
+                stop = high if step else start
+            if not low <= start <= stop <= high:
+                raise ValueError(f"Значение {part!r} вне диапазона {low}-{high}")
+            values.update(range(start, stop + 1, int(step) if step else 1))
+        return values
+
+    def _day_matches(self, moment: datetime) -> bool:
+        day = moment.day in self._days
+        weekday = (moment.weekday() + 1) % 7 in self._weekdays
+        if self._any_day or self._any_weekday:
+            return day and weekday
+        return day or weekday
+
+    def next_after(self, moment: datetime) -> datetime:
+        moment = moment.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = moment + timedelta(days=366 * 5)
+
+        while moment < limit:
+            if moment.month not in self._months:
+                moment = (moment.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(moment):
+                moment = moment.replace(hour=0, minute=0) + timedelta(days=1)
+            elif moment.hour not in self._hours:
+                moment = moment.replace(minute=0) + timedelta(hours=1)
+            elif moment.minute not in self._minutes:
+                moment += timedelta(minutes=1)
+            else:
+                return moment
+        raise ValueError(f"Расписание {self._spec!r} не срабатывает")
+
+
+class Job:
+    """
+    Задание планировщика: корутина, триггер и учёт запусков.
+    Корутина может вернуть False - запуск считается неготовым (например, нет коннектора)
+    и повторяется через retry секунд, не дожидаясь следующего срабатывания триггера
+    """
+
+    def __init__(self, name: str, func: Callable[[], Awaitable], trigger: IntervalTrigger | CronTrigger,
+                 jitter: float, misfire_grace: float, retry: float | None) -> None:
+        self.name = name
+        self.func = func
+        self.trigger = trigger
+        self.jitter = jitter
+        self.misfire_grace = misfire_grace
+        self.retry = retry
+        self.next_run = None
+        self.task = None
+        self.last_run = None
+        self.duration = None
+        self.outcome = None
+        self.counters = {'runs': 0, 'failures': 0, 'overlaps': 0, 'misfires': 0}
+
+    def schedule(self, moment: datetime) -> None:
+        self.next_run = self.trigger.next_after(moment) + timedelta(seconds=random.uniform(0, self.jitter))
+
+    def stats(self) -> dict:
+        return dict(self.counters,
+                    running=self.task is not None and not self.task.done(),
+                    next_run=self.next_run and self.next_run.isoformat(timespec='seconds'),
+                    last_run=self.last_run and self.last_run.isoformat(timespec='seconds'),
+                    duration=self.duration,
+                    outcome=self.outcome)
+
+
+class Scheduler:
+    """
+    Класс планировщика заданий на текущем event loop:
+    1. Задания запускаются по интервалу или по cron-расписанию, независимые задания выполняются параллельно
+    2. Задание не запускается повторно, пока не завершился его предыдущий запуск (срабатывание пропускается)
+    3. Срабатывание, опоздавшее больше чем на misfire_grace секунд, пропускается и переносится на следующее
+    4. К каждому срабатыванию добавляется случайная задержка до jitter секунд
+    5. Для каждого задания хранится время последнего запуска, длительность и результат
+    """
+
+    def __init__(self, misfire_grace: float, jitter: float = 0) -> None:
+        self._misfire_grace = misfire_grace
+        self._jitter = jitter
+        self._jobs = {}
+        self._wakeup = asyncio.Event()
+
+    def add_job(self, name: str, func: Callable[[], Awaitable], trigger: IntervalTrigger | CronTrigger,
+                immediately: bool = False, retry: float = None) -> Job:
+        job = Job(name, func, trigger, self._jitter, self._misfire_grace, retry)
+        if immediately:
+            job.next_run = datetime.now()
+        else:
+            job.schedule(datetime.now())
+        self._jobs[name] = job
+        self._wakeup.set()
+        return job
+
+    async def run(self) -> Awaitable:
+        try:
+            while True:
+                self._wakeup.clear()
+                now = datetime.now()
+                for job in self._jobs.values():
+                    if job.next_run <= now:
+                        self._launch(job, now)
+
+                wake = min((job.next_run for job in self._jobs.values()), default=now + timedelta(minutes=1))
+                delay = min(max((wake - datetime.now()).total_seconds(), 0), 60)
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            for job in self._jobs.values():
+                if job.task is not None:
+                    job.task.cancel()
+
+    def _launch(self, job: Job, now: datetime) -> None:
+        late = (now - job.next_run).total_seconds()
+        job.schedule(now)
+
+        if job.task is not None and not job.task.done():
+            job.counters['overlaps'] += 1
+            logger.warning(f"Задание {job.name} ещё выполняется, запуск пропущен (следующий {job.next_run})")
+        elif late > job.misfire_grace:
+            job.counters['misfires'] += 1
+            logger.warning(f"Задание {job.name} опоздало на {late:.0f} s, запуск пропущен (следующий {job.next_run})")
+        else:
+            job.task = asyncio.create_task(self._execute(job))
+
+    async def _execute(self, job: Job) -> None:
+        job.last_run = datetime.now()
+        job.counters['runs'] += 1
+        started = time.perf_counter()
+
+        try:
+            result = await job.func()
+        except asyncio.CancelledError:
+            job.outcome = 'cancelled'
+            raise
+        except Exception as error:
+            job.counters['failures'] += 1
+            job.outcome = f'error: {error}'
+            logger.error(f'Ошибка в задании {job.name}: {error}', exc_info=True)
+        else:
+            job.outcome = 'not_ready' if result is False else 'success'
+            if result is False and job.retry is not None:
+                job.next_run = min(job.next_run, datetime.now() + timedelta(seconds=job.retry))
+                self._wakeup.set()
+        finally:
+            job.duration = round(time.perf_counter() - started, 3)
+            job_seconds.observe(job.duration, job=job.name, outcome=(job.outcome or 'error').split(':')[0])
+
+        logger.warning(f"Задание {job.name}: {job.outcome} за {job.duration} s")
+
+    def stats(self) -> dict[str, dict]:
+        return {name: job.stats() for name, job in self._jobs.items()}
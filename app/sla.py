@@ -0,0 +1,145 @@
+import numpy as np
+from comments import clean_comment
+
+
+class SlaEngine:
+    """
+    Класс пакетного анализа превышения SLA по закрытым тикетам (замена Analytics.analise для выборок):
+    1. Для каждого тикета находится первая учитываемая задача, они собираются в столбцы
+    2. Время работы задач, превышение SLA и поля текста считаются векторно (datetime64, секунды)
+    3. Текст и группа формируются только для тикетов с превышением, результат совпадает с Analytics.analise:
+       анализ, как и там, останавливается на первой учитываемой задаче тикета
+    4. Тикет, на котором Analytics.analise завершился бы ошибкой, получает результат None:
+       поля задач до первой учитываемой читаются так же строго, как в Analytics.analise
+    """
+
+    skipped_types = ('Ожидание', 'Запрос клиента')
+    counted_waits = ('Решение сетевого ТТ', 'Решение базового ТТ')
+
+    def __init__(self, comment_limit: int) -> None:
+        self._comment_limit = comment_limit
+
+    def analise(self, tickets: list[dict]) -> list[tuple[str, str, str] | None]:
+        results = [None] * len(tickets)
+        closed, slas = [], []
+
+        for index, ticket in enumerate(tickets):
+            try:
+                sla = int(ticket['ola']['ksSla'])
+            except (KeyError, TypeError, ValueError):
+                continue
+            if ticket.get('status') == 'Закрыт':
+                closed.append(index)
+                slas.append(sla)
+
+        chosen, positions = [], []
+        for position, index in enumerate(closed):
+            try:
+                task = next(filter(self._counted, tickets[index]['tasks']), None)
+            except (KeyError, TypeError):
+                continue
+            if task is not None:
+                chosen.append(task)
+                positions.append(position)
+
+        if not chosen:
+            return results
+        positions = np.array(positions, dtype=np.int64)
+
+        created = self._parse([task.get('createTs') for task in chosen])
+        completed = self._parse([task.get('completionDate') for task in chosen])
+        valid = ~(np.isnat(created) | np.isnat(completed))
+        minutes = (completed - created).astype(np.int64) / 60
+        breach = valid & (minutes >= np.array(slas, dtype=np.int64)[positions])
+
+        hits = np.flatnonzero(breach)
+        raw_assign = [chosen[hit].get('assignmentDate') for hit in hits]
+        assigned = np.where([bool(value) for value in raw_assign], self._parse(raw_assign), created[hits])
+        broken = set(hits[np.isnat(assigned)].tolist())
+        times = dict(zip(hits.tolist(), zip(
+            np.datetime_as_string(created[hits], unit='s'),
+            np.datetime_as_string(assigned, unit='s'),
+            np.datetime_as_string(completed[hits], unit='s'),
+            (assigned - created[hits]).tolist(),
+            (completed[hits] - assigned).tolist(),
+            (completed[hits] - created[hits]).tolist()
+        )))
+
+        for row, (position, task) in enumerate(zip(positions.tolist(), chosen)):
+            if not valid[row] or row in broken:
+                continue
+
+            try:
+                text, group = self._describe(task, times[row]) if row in times else ('', 'SLA не превышен')
+            except (KeyError, TypeError):
+                continue
+            results[closed[position]] = (text, group, self._close_date(tickets[closed[position]]))
+        return results
+
+    def _counted(self, task: dict) -> bool:
+        if task['typeName'] not in self.skipped_types:
+            return True
+        if task['typeName'] == 'Ожидание':
+            return task['taskExecutorDTO']['execUnitName'] in self.counted_waits
+        return False
+
+    @staticmethod
+    def _parse(values: list) -> np.ndarray:
+        values = [value[0:19] if isinstance(value, str) else '' for value in values]
+        try:
+            return np.array(values, dtype='datetime64[s]')
+        except ValueError:
+            parsed = []
+            for value in values:
+                try:
+                    parsed.append(np.datetime64(value, 's'))
+                except ValueError:
+                    parsed.append(np.datetime64('NaT', 's'))
+            return np.array(parsed, dtype='datetime64[s]')
+
+    @staticmethod
+    def _close_date(ticket: dict) -> str:
+        if ticket.get('closeDate'):
+            return str(ticket['closeDate']).split("T")[0]
+        return 'Не удалось определить'
+
+    def _describe(self, task: dict, times: tuple) -> tuple[str, str]:
+        info, group = breach_info(task, times, self._comment_limit)
+        return format_info(info), group
+
+
+def breach_info(task: dict, times: tuple, comment_limit: int) -> tuple[dict, str]:
+    """
+    Поля текста о превышении SLA на задаче и группа, на которой оно произошло (общие для Analytics.analise и SlaEngine):
+    times - время создания, принятия в работу и закрытия задачи (строки), время реакции, решения и всё
+    """
+    time_create, time_assign, time_close, reaction, solution, total = times
+    group = task['taskExecutorDTO']['execUnitName']
+
+    if task.get('taskComments') and len(task['taskComments'][-1]['comment']) > 0:
+        end_comment = clean_comment(task['taskComments'][-1]['comment'], comment_limit)
+        end_comment = end_comment or "Комментарий отсутствует"
+    else:
+        end_comment = "Комментарий отсутствует"
+
+    analise_info = {'Результат': f"SLA превышен",
+                    'Просрочено на группе': group,
+                    'Номер запроса': task['taskNumber'],
+                    'Время создания запроса': time_create,
+                    'Время принятия в работу': time_assign,
+                    'Время закрытия запроса': time_close,
+                    'Время реакции': reaction,
+                    'Время решения': solution,
+                    'Время всё': total,
+                    'Последний комментарий (task)': end_comment}
+
+    if group == 'Вендор (ДЭФИР)' and task.get('foreignTicketId'):
+        group = f"{task['providerName']}"
+    elif group == 'Провайдер' and task.get('foreignTicketId'):
+        group = f"Провайдер ({task['providerName']})"
+
+    return analise_info, group
+
+
+def format_info(info: dict) -> str:
+    return '\n'.join(map(lambda x: f"{x[0]}: {x[1]}", info.items()))
@@ -0,0 +1,24 @@
+from datetime import datetime, timedelta
+from functools import lru_cache
+
+
+@lru_cache(maxsize=65536)
+def parse(value: str) -> datetime:
+    """Разбирает метку времени NTTM вида 2023-01-25T10:15:00.000+0300 без учёта долей секунды и зоны"""
+    return datetime.fromisoformat(value[0:19])
+
+
+@lru_cache(maxsize=4096)
+def parse_date(value: str) -> datetime:
+    """Разбирает дату (часть метки времени до T) в полночь этого дня"""
+    return datetime.fromisoformat(value.split('T')[0])
+
+
+def day_window(now: datetime = None) -> tuple[datetime, datetime]:
+    """Возвращает полночь вчерашнего и позавчерашнего дня, считается один раз на запуск отчёта"""
+    today = (now or datetime.now()).replace(hour=0, minute=0, second=0, microsecond=0)
+    return today - timedelta(days=1), today - timedelta(days=2)
+
+
+def cache_stats() -> dict[str, dict]:
+    return {'parse': parse.cache_info()._asdict(), 'parse_date': parse_date.cache_info()._asdict()}
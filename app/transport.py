@@ -0,0 +1,80 @@
+import itertools
+import json
+import struct
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+_chunk_header = struct.Struct('>BIII')
+_chunk_marker = 1
+
+
+def _encoders() -> dict[str, tuple]:
+    encoders = {'json': (lambda data: json.dumps(data, ensure_ascii=False, default=str), json.loads)}
+    if orjson is not None:
+        encoders['orjson'] = (lambda data: orjson.dumps(data, default=str, option=orjson.OPT_NON_STR_KEYS),
+                              orjson.loads)
+    if msgpack is not None:
+        encoders['msgpack'] = (lambda data: msgpack.packb(data, default=str),
+                               lambda data: msgpack.unpackb(data, raw=False, strict_map_key=False))
+    return encoders
+
+
+encoders = _encoders()
+
+
+def subprotocols(preferred: list[str]) -> list[str]:
+    """Возвращает подпротоколы вебсокета (nttm.<кодек>) для установленных кодеков в порядке предпочтения"""
+    return [f'nttm.{name}' for name in preferred if name in encoders]
+
+
+class MessageCodec:
+    """
+    Класс сериализации сообщений между сервером и коннектором:
+    1. Кодек согласуется при подключении через подпротокол вебсокета (nttm.orjson, nttm.msgpack),
+       без подпротокола (старый коннектор) используется json
+    2. Сообщение больше chunk_size байт отправляется частями (бинарные кадры с заголовком),
+       поэтому размер сообщения не ограничен max_size вебсокета
+    3. Части собираются на принимающей стороне, decode возвращает None, пока сообщение не собрано целиком
+    """
+
+    def __init__(self, subprotocol: str | None, chunk_size: int) -> None:
+        name = (subprotocol or '').removeprefix('nttm.')
+        self.name = name if name in encoders else 'json'
+        self._dumps, self._loads = encoders[self.name]
+        self._chunk_size = chunk_size
+        self._message_ids = itertools.count(1)
+        self._parts = {}
+
+    def encode(self, message: dict) -> list[str | bytes]:
+        frame = self._dumps(message)
+        payload = frame.encode('utf-8') if isinstance(frame, str) else frame
+        if len(payload) <= self._chunk_size:
+            return [frame]
+
+        message_id = next(self._message_ids) & 0xFFFFFFFF
+        total = -(-len(payload) // self._chunk_size)
+        return [_chunk_header.pack(_chunk_marker, message_id, index, total)
+                + payload[index * self._chunk_size:(index + 1) * self._chunk_size]
+                for index in range(total)]
+
+    def decode(self, frame: str | bytes) -> dict | None:
+        if isinstance(frame, bytes) and frame[:1] == bytes([_chunk_marker]):
+            _, message_id, index, total = _chunk_header.unpack_from(frame)
+            parts = self._parts.setdefault(message_id, [None] * total)
+            parts[index] = frame[_chunk_header.size:]
+            if any(part is None for part in parts):
+                return None
+            frame = b''.join(self._parts.pop(message_id))
+        return self._loads(frame)
+
+    def stats(self) -> dict[str, str | int]:
+        return {'codec': self.name, 'partial_messages': len(self._parts)}
@@ -1,11 +1,12 @@
 import datetime
 import random
 import hashlib
-import threading
-import json
-import time
+import itertools
 import asyncio
+import time
 import websockets
+import metrics
+from transport import MessageCodec, subprotocols
 from typing import Coroutine, Awaitable
 from log import logger
 from envparse import Env
@@ -16,6 +17,16 @@ env.read_envfile('.env')
 
 key = env.str("KEY")
 token = env.str("TOKEN")
+strategy = env.str("DISPATCH", default="least_outstanding")
+codecs = env.list("WS_CODECS", default=["orjson", "msgpack", "json"])
+compression = env.str("WS_COMPRESSION", default="deflate")
+chunk_size = env.int("WS_CHUNK", default=1048576)
+task_queue = env.int("TASK_QUEUE", default=1000)
+
+task_seconds = metrics.registry.histogram('analytics_task_seconds', 'Время выполнения задания коннектором',
+                                          ('type', 'status'))
+task_timeouts = metrics.registry.counter('analytics_task_timeouts_total', 'Задания, не выполненные за таймаут',
+                                         ('type',))
 
 
 class ConnectorNTTM:
@@ -23,108 +34,247 @@ class ConnectorNTTM:
     Класс для взаимодействия клиента (система NTTM) с сервером:
     1. Сервер проверяет наличие подключенных клиентов
     2. Сервер создаёт задачу, присваивает ей ID и помещает в очередь на отправку клиенту
+       (клиент выбирается по стратегии least_outstanding или round_robin среди клиентов с кредитом)
     3. Клиент получает запрос, обрабатывает его и оправляет результат серверу
     4. Сервер получая ответ от клиента отдаёт результат работы запрашиваемому его методу
     5. Если задача не выполнена за период таймаута, сервер получает соответствующее сообщение
+    6. Очередь заданий ограничена (create_task ждёт места в ней), клиент сообщает сообщением credit,
+       сколько заданий готов принять, и больше этого ему не отправляется (клиент без credit не ограничивается,
+       из первого кредита вычитаются задания, отправленные клиенту до него)
     """
 
     def __init__(self) -> None:
         self.clients = []
-        self._queue_tasks = asyncio.Queue()
-        self._complete_tasks = {}
-        self._max_id = 100
-        self._end_id = 0
-        self._lock = threading.RLock()
+        self._queue_tasks = asyncio.Queue(maxsize=task_queue)
+        self._outbound = {}
+        self._codecs = {}
+        self._credits = {}
+        self._credit_event = asyncio.Event()
+        self._workers = {}
+        self._in_flight = {}
+        self._assigned = {}
+        self._strategy = strategy
+        self._rr_index = -1
+        self._pending_tasks = {}
+        self._timeout = 300
+        self._queue_size = 1000
+        self._task_ids = itertools.count(1)
+        self._rejected_replies = 0
 
     async def _send(self) -> Awaitable:
-        ws = None
         while True:
+            task = await self._queue_tasks.get()
+            task_id = task['task_id']
             try:
-                if self.clients:
-                    task = self._queue_tasks.get_nowait()
-                    ws = self.clients[0]
-                    logger.debug(f"{ws.remote_address} send: {task}")
-                    await ws.send(json.dumps(task))
-                await asyncio.sleep(0.01)
-
-            except asyncio.QueueEmpty:
-                await asyncio.sleep(0.01)
-            except Exception as error:
-                logger.error(error, exc_info=True)
-                await self._disconnect(ws)
+                if task_id not in self._pending_tasks:
+                    continue
 
-    async def _recv(self) -> Awaitable:
-        ws = None
-        while True:
-            try:
-                for ws in self.clients:
-                    message = await asyncio.wait_for(ws.recv(), timeout=0.01)
-                    if message:
-                        message = json.loads(message)
-                        self._complete_tasks[message.pop('task_id')] = message
-                        logger.debug(f"{ws.remote_address} recv: {str(message)[:400]}...")
+                ws = await self._select_client()
+                if ws is None:
+                    self._fail_task(task_id, ConnectionError('module not connect'))
+                    continue
 
-                await asyncio.sleep(0.01)
+                self._in_flight[ws][task_id] = task
+                self._assigned[task_id] = ws
+                await self._deliver(ws, task)
 
-            except asyncio.TimeoutError:
-                await asyncio.sleep(0.01)
             except Exception as error:
                 logger.error(error, exc_info=True)
-                await self._disconnect(ws)
+                self._fail_task(task_id, ConnectionError(str(error)))
+
+    async def _deliver(self, ws: websockets.connect, task: dict) -> Awaitable:
+        """
+        Кладёт задание в очередь отправки клиента, ожидание прерывается, если клиент отключился
+        (задание уже числится за клиентом, и remove_client переназначит его)
+        """
+        put = asyncio.ensure_future(self._outbound[ws].put(task))
+        try:
+            await asyncio.wait((put, self._workers[ws][1]), return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            put.cancel()
+
+    async def _select_client(self) -> websockets.connect | None:
+        while self.clients:
+            clients = [ws for ws in self.clients if self._credits[ws] is None or self._credits[ws] > 0]
+            if not clients:
+                self._credit_event.clear()
+                await self._credit_event.wait()
+                continue
+
+            if self._strategy == 'round_robin':
+                self._rr_index = (self._rr_index + 1) % len(clients)
+                ws = clients[self._rr_index]
+            else:
+                ws = min(clients, key=lambda client: len(self._in_flight[client]))
+            if self._credits[ws] is not None:
+                self._credits[ws] -= 1
+            return ws
+
+    def _grant(self, ws: websockets.connect, credit: int) -> None:
+        if ws in self._credits:
+            if self._credits[ws] is None:
+                credit -= len(self._in_flight[ws])
+            self._credits[ws] = (self._credits[ws] or 0) + credit
+            self._credit_event.set()
+
+    async def _writer(self, ws: websockets.connect) -> Coroutine:
+        queue = self._outbound[ws]
+        codec = self._codecs[ws]
+        try:
+            while True:
+                task = await queue.get()
+                logger.debug(f"{ws.remote_address} send: {task}")
+                for frame in codec.encode(task):
+                    await ws.send(frame)
+
+        except asyncio.CancelledError:
+            raise
+        except Exception as error:
+            logger.error(error, exc_info=True)
+            await self._disconnect(ws)
+
+    async def _reader(self, ws: websockets.connect) -> Coroutine:
+        codec = self._codecs[ws]
+        try:
+            async for message in ws:
+                try:
+                    message = codec.decode(message)
+                    if message is None:
+                        continue
+                    if message.get('type') == 'credit':
+                        self._grant(ws, int(message['credit']))
+                        continue
+                    self._resolve_task(ws, message.pop('task_id'), message)
+                    logger.debug(f"{ws.remote_address} recv: {str(message)[:400]}...")
+                except (ValueError, KeyError, AttributeError) as error:
+                    logger.error(f"{ws.remote_address} некорректное сообщение: {error}")
+
+        except websockets.ConnectionClosed:
+            pass
+        except Exception as error:
+            logger.error(error, exc_info=True)
+            await self._disconnect(ws)
 
     async def _disconnect(self, ws: websockets.connect) -> Coroutine:
+        if ws.open:
+            await ws.close()
+
+    def add_client(self, ws: websockets.connect, codec: MessageCodec) -> None:
+        self._outbound[ws] = asyncio.Queue(maxsize=self._queue_size)
+        self._codecs[ws] = codec
+        self._credits[ws] = None
+        self._in_flight[ws] = {}
+        self._workers[ws] = (asyncio.create_task(self._reader(ws)), asyncio.create_task(self._writer(ws)))
+        self.clients.append(ws)
+        self._credit_event.set()
+        logger.info(f"client {ws.service} {ws.remote_address} connect (codec {codec.name})")
+
+    def remove_client(self, ws: websockets.connect) -> None:
         if ws in self.clients:
-            if ws.open:
-                await ws.close()
             self.clients.remove(ws)
+            for worker in self._workers.pop(ws, ()):
+                worker.cancel()
+            self._outbound.pop(ws, None)
+            self._codecs.pop(ws, None)
+            self._credits.pop(ws, None)
+            self._credit_event.set()
             logger.warning(f"client {ws.service} {ws.remote_address} disconnect")
 
+            orphans = list(self._in_flight.pop(ws, {}).values())
+            for task in orphans:
+                self._assigned.pop(task['task_id'], None)
+
+            if self.clients:
+                for task in orphans:
+                    asyncio.create_task(self._queue_tasks.put(task))
+                if orphans:
+                    logger.warning(f"Переназначено заданий клиента {ws.remote_address}: {len(orphans)}")
+            else:
+                for task in orphans:
+                    self._fail_task(task['task_id'], ConnectionError(f"client {ws.service} disconnect"))
+
+    def _resolve_task(self, ws: websockets.connect, task_id: int, message: dict) -> None:
+        self._in_flight.get(ws, {}).pop(task_id, None)
+        self._assigned.pop(task_id, None)
+        future = self._pending_tasks.get(task_id)
+
+        if future is None:
+            self._rejected_replies += 1
+            logger.warning(f"Отклонён ответ на неизвестное или устаревшее задание ({task_id})")
+        elif not future.done():
+            future.set_result(message)
+
+    def _fail_task(self, task_id: int, error: Exception) -> None:
+        future = self._pending_tasks.get(task_id)
+        if future is not None and not future.done():
+            future.set_exception(error)
+
     def run(self) -> None:
         asyncio.create_task(self._send())
-        asyncio.create_task(self._recv())
 
     def check_client(self) -> bool:
         if len(self.clients) > 0:
             return True
         return False
 
-    async def create_task(self, task: dict) -> dict[str, dict]:
+    def stats(self) -> dict[str, int]:
+        return {'pending': len(self._pending_tasks),
+                'in_flight': sum(len(tasks) for tasks in self._in_flight.values()),
+                'queued': self._queue_tasks.qsize(),
+                'outbound': sum(queue.qsize() for queue in self._outbound.values()),
+                'credits': sum(credit for credit in self._credits.values() if credit is not None),
+                'rejected_replies': self._rejected_replies}
+
+    async def create_task(self, task: dict, timeout: int | float = None) -> dict[str, dict]:
         if len(self.clients) == 0:
             return {'status_code': 501, 'result': 'module not connect'}
 
-        with self._lock:
-            if self._end_id < self._max_id:
-                task_id = self._end_id + 1
-                self._end_id = task_id
-            else:
-                task_id = 1
-                self._end_id = 1
-
-            task.update(task_id=task_id)
-            self._queue_tasks.put_nowait(task)
-
-        timeout = 300
-        limit_time = timeout + time.time()
+        future = asyncio.get_running_loop().create_future()
+        started, status = time.perf_counter(), None
 
-        while True:
-            with self._lock:
-                if task_id in self._complete_tasks:
-                    return self._complete_tasks.pop(task_id)
-
-            if limit_time < time.time():
-                text = f'Задание ({task}) не выполнено: timeout error'
-                logger.error(text)
-                return {'status_code': 500, 'result': text}
-            await asyncio.sleep(0.1)
+        task_id = next(self._task_ids)
+        task.update(task_id=task_id)
+        self._pending_tasks[task_id] = future
 
-    async def get_tasks(self, key_filter: str) -> dict[str, dict]:
+        try:
+            async with asyncio.timeout(timeout or self._timeout):
+                await self._queue_tasks.put(task)
+                result = await future
+                status = result.get('status_code')
+                return result
+
+        except TimeoutError:
+            status = 'timeout'
+            task_timeouts.inc(type=task.get('type'))
+            text = f'Задание ({task}) не выполнено: timeout error'
+            logger.error(text)
+            return {'status_code': 500, 'result': text}
+        except ConnectionError as err:
+            status = 'disconnect'
+            text = f'Задание ({task}) не выполнено: {err}'
+            logger.error(text)
+            return {'status_code': 503, 'result': text}
+        finally:
+            task_seconds.observe(time.perf_counter() - started, type=task.get('type'), status=status)
+            if self._pending_tasks.get(task_id) is future:
+                del self._pending_tasks[task_id]
+            ws = self._assigned.pop(task_id, None)
+            if ws is not None:
+                self._in_flight.get(ws, {}).pop(task_id, None)
+
+    async def get_tasks(self, key_filter: str, timeout: int | float = None) -> dict[str, dict]:
         task = {'type': 'get_tasks', 'filter': key_filter}
-        completed_task = await self.create_task(task)
+        completed_task = await self.create_task(task, timeout)
         return completed_task
 
-    async def get_inc(self, inc: int) -> dict[str, dict]:
+    async def get_inc(self, inc: int, timeout: int | float = None) -> dict[str, dict]:
         task = {'type': 'get_inc', 'inc': str(inc)}
-        completed_task = await self.create_task(task)
+        completed_task = await self.create_task(task, timeout)
+        return completed_task
+
+    async def get_incs(self, incs: list[int], timeout: int | float = None) -> dict[str, dict]:
+        task = {'type': 'get_incs', 'incs': [str(inc) for inc in incs]}
+        completed_task = await self.create_task(task, timeout)
         return completed_task
 
 
@@ -135,6 +285,9 @@ class ServerServices:
     2. Сервису передается СОЛЬ
     3. От сервиса ожидается хеш (sha256: ТОКЕН + СОЛЬ + КЛЮЧ)
     4. От сервиса ожидается название модуля (такое же, как свойство класса, например, nttm)
+    5. Кодек сообщений берётся из согласованного при подключении подпротокола (по умолчанию json),
+       сжатие permessage-deflate согласуется там же
+    6. Сервер запускается (create_server) на event loop приложения, общем с core()
     """
 
     def __init__(self, port: int) -> None:
@@ -142,14 +295,14 @@ class ServerServices:
         self._TOKEN = token
         self._KEY = key
         self.nttm = ConnectorNTTM()
+        self._server = None
 
-        threading.Thread(target=lambda: asyncio.run(self.create_server()), daemon=True).start()
-
-    async def create_server(self) -> Awaitable:
+    async def create_server(self) -> websockets.WebSocketServer:
         self.nttm.run()
+        self._server = await websockets.serve(self._authentication, port=self._port, max_size=10240000,
+                                              compression=compression or None, subprotocols=subprotocols(codecs))
         logger.info("webserver start")
-        async with websockets.serve(self._authentication, port=self._port, max_size=10240000):
-            await asyncio.Future()
+        return self._server
 
     async def _authentication(self, ws: websockets.connect) -> Coroutine:
         try:
@@ -169,13 +322,9 @@ class ServerServices:
                     if service_name in self.__dict__:
                         service = self.__getattribute__(service_name)
                         ws.service = service_name
-                        logger.info(f"client {ws.service} {ws.remote_address} connect")
-                        service.clients.append(ws)
+                        service.add_client(ws, MessageCodec(ws.subprotocol, chunk_size))
                         await ws.wait_closed()
-
-                        if ws in service.clients:
-                            service.clients.remove(ws)
-                            logger.warning(f"client {ws.service} {ws.remote_address} disconnect")
+                        service.remove_client(ws)
                     else:
                         await ws.close(code=4002, reason='Service is not supported')
                 else:
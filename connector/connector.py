@@ -3,12 +3,17 @@ import aiohttp
 import fake_useragent
 import websockets
 import hashlib
+import base64
 import json
 import logging
+import time
 from typing import Coroutine, Awaitable
 from datetime import datetime
 from datetime import timedelta
 from log import logger
+from resilience import RetryPolicy, CircuitBreaker, TokenBucket
+from transport import MessageCodec, subprotocols
+import metrics
 from envparse import Env
 
 
@@ -21,6 +26,30 @@ url = env.str("URL")
 key = env.str("KEY")
 server = env.str("SERVER")
 password = env.str("PASSWORD")
+page_concurrency = env.int("PAGE_CONCURRENCY", default=4)
+pool_size = env.int("POOL_SIZE", default=100)
+pool_per_host = env.int("POOL_PER_HOST", default=50)
+keepalive = env.float("KEEPALIVE", default=30)
+dns_cache = env.int("DNS_CACHE", default=300)
+retry_attempts = env.int("RETRY_ATTEMPTS", default=3)
+retry_base = env.float("RETRY_BASE", default=0.5)
+retry_max = env.float("RETRY_MAX", default=30)
+breaker_failures = env.int("BREAKER_FAILURES", default=5)
+breaker_reset = env.float("BREAKER_RESET", default=30)
+codecs = env.list("WS_CODECS", default=["orjson", "msgpack", "json"])
+compression = env.str("WS_COMPRESSION", default="deflate")
+chunk_size = env.int("WS_CHUNK", default=1048576)
+task_credit = env.int("TASK_CREDIT", default=64)
+metrics_port = env.int("METRICS_PORT", default=9101)
+rate_limits = {
+    'authenticate': env.float("RATE_AUTH", default=1),
+    'filters': env.float("RATE_FILTERS", default=5),
+    'page': env.float("RATE_PAGE", default=5),
+    'ticket': env.float("RATE_TICKET", default=50),
+}
+
+http_seconds = metrics.registry.histogram('connector_http_seconds', 'Время запроса к NTTM', ('request', 'code'))
+http_responses = metrics.registry.counter('connector_http_responses_total', 'Ответы NTTM по кодам', ('request', 'code'))
 
 
 class ConnectorNTTM:
@@ -28,8 +57,12 @@ class ConnectorNTTM:
     Класс для работы клиента с системой NTTM и взаимодействия с сервером:
     1. Клиент использует УЗ пользователя NTTM
     2. Клиент создаёт и обновляет сессию в пределах которой совершает запросы
+       (сессия живёт всё время работы клиента и держит пул keep-alive соединений,
+       токен обновляется заранее по полю exp одним запросом для всех корутин)
     3. Получая задание от сервера, клиент помещает его в очередь и создаёт запрос в систему
     4. Получая ответ от системы, клиент помещает результат в очередь на отправку клиенту
+    5. Очереди ограничены: одновременно выполняется не больше capacity заданий, столько же кредитов
+       клиент выдаёт серверу и возвращает их по мере отправки результатов
     """
 
     def __init__(self, loop: asyncio.get_event_loop) -> None:
@@ -37,18 +70,101 @@ class ConnectorNTTM:
         self._password = password
         self._url = url
         self._user_agent = fake_useragent.UserAgent().random
-        self.tasks = asyncio.Queue()
-        self.results = asyncio.Queue()
-        self._timer = 0
-        self._active_session = 0
+        self.capacity = task_credit
+        self.tasks = asyncio.Queue(maxsize=task_credit)
+        self.results = asyncio.Queue(maxsize=task_credit)
+        self._slots = asyncio.Semaphore(task_credit)
+        self._running = 0
+        self._timer = datetime.now()
+        self._refresh_at = datetime.now()
+        self._refresh_task = None
+        self._auth_lock = asyncio.Lock()
         self._session = []
+        self._pool = None
+        self._pool_stats = {'created': 0, 'reused': 0, 'active': 0}
+        self._retry = RetryPolicy(retry_attempts, retry_base, retry_max)
+        self._breaker = CircuitBreaker(breaker_failures, breaker_reset)
+        self._limiters = {name: TokenBucket(rate) for name, rate in rate_limits.items()}
         self._loop = loop
+        self._page_concurrency = page_concurrency
+        self._page_retries = 2
+        self._page_sizes = {'ticket': 100, 'task': 500}
+        self._page_limits = (50, 1000)
+        self._page_time = (5, 30)
 
         loop.create_task(self._core())
 
+    def _create_pool(self) -> aiohttp.ClientSession:
+        async def on_create(*_) -> None:
+            self._pool_stats['created'] += 1
+
+        async def on_reuse(*_) -> None:
+            self._pool_stats['reused'] += 1
+
+        async def on_start(*_) -> None:
+            self._pool_stats['active'] += 1
+
+        async def on_end(*_) -> None:
+            self._pool_stats['active'] -= 1
+
+        trace = aiohttp.TraceConfig()
+        trace.on_connection_create_end.append(on_create)
+        trace.on_connection_reuseconn.append(on_reuse)
+        trace.on_request_start.append(on_start)
+        trace.on_request_end.append(on_end)
+        trace.on_request_exception.append(on_end)
+
+        connector = aiohttp.TCPConnector(limit=pool_size, limit_per_host=pool_per_host,
+                                         keepalive_timeout=keepalive, ttl_dns_cache=dns_cache)
+        return aiohttp.ClientSession(connector=connector, trace_configs=[trace])
+
+    def pool_stats(self) -> dict[str, int | float]:
+        connections = self._pool_stats['created'] + self._pool_stats['reused']
+        reuse_rate = self._pool_stats['reused'] / connections if connections else 0.0
+        return dict(self._pool_stats, limit=pool_size, limit_per_host=pool_per_host, reuse_rate=reuse_rate)
+
+    def resilience_stats(self) -> dict[str, dict]:
+        return {'retry': self._retry.stats(), 'breaker': self._breaker.stats(),
+                'limiter': {name: limiter.stats() for name, limiter in self._limiters.items()}}
+
+    @staticmethod
+    def _request_kind(url: str) -> str:
+        if '/api/authenticate' in url:
+            return 'authenticate'
+        if '/api/user-filters/' in url:
+            return 'filters'
+        if url.endswith('/page'):
+            return 'page'
+        return 'ticket'
+
+    def _limiter(self, url: str) -> TokenBucket:
+        return self._limiters[self._request_kind(url)]
+
+    def register_metrics(self) -> None:
+        registry = metrics.registry
+        registry.collect('connector_queue', 'Очереди коннектора: задания, результаты, выполняются, ёмкость',
+                         self.queue_stats, ('queue',))
+        registry.collect('connector_pool', 'Пул соединений к NTTM (created, reused, active, reuse_rate)',
+                         lambda: {field: value for field, value in self.pool_stats().items()
+                                  if field in ('created', 'reused', 'active', 'reuse_rate')}, ('field',))
+        registry.collect('connector_retries_total', 'Повторы запросов к NTTM по кодам',
+                         lambda: self._retry.stats()['by_status'], ('code',), kind='counter')
+        registry.collect('connector_retries_exhausted_total', 'Запросы к NTTM, исчерпавшие повторы',
+                         lambda: self._retry.stats()['exhausted'], kind='counter')
+        registry.collect('connector_breaker_open', 'Выключатель запросов к NTTM открыт',
+                         lambda: self._breaker.stats()['state'] != 'closed')
+        registry.collect('connector_breaker_rejected_total', 'Запросы, отклонённые выключателем',
+                         lambda: self._breaker.stats()['rejected'], kind='counter')
+        registry.collect('connector_limiter_wait_seconds_total', 'Суммарное ожидание ограничителя частоты',
+                         lambda: {name: limiter.stats()['waited_total'] for name, limiter in self._limiters.items()},
+                         ('request',), kind='counter')
+
     async def _create_session(self) -> Coroutine:
         while True:
-            session = aiohttp.ClientSession()
+            if self._pool is None or self._pool.closed:
+                self._pool = self._create_pool()
+
+            session = self._pool
             payload = json.dumps(dict(username=self._email, password=self._password, force=True))
             headers = {
                 'Accept': 'application/json, text/plain, */*',
@@ -56,85 +172,112 @@ class ConnectorNTTM:
                 'Content-Type': 'application/json'
             }
             method = "/nttm-task-handler/api/authenticate"
-            response = await session.post(self._url + method, data=payload, headers=headers)
-
-            if response.status == 200:
-                headers = {
-                    'User-Agent': self._user_agent,
-                    'Content-Type': 'application/json',
-                    'Authorization': 'Bearer ' + (await response.json())['id_token']
-                }
-                self._session = [session, headers]
-                break
-            else:
-                logger.error(await response.text())
-                await asyncio.sleep(5)
+            try:
+                await self._limiter(method).acquire()
+                async with session.post(self._url + method, data=payload, headers=headers) as response:
+                    if response.status == 200:
+                        id_token = (await response.json())['id_token']
+                        headers = {
+                            'User-Agent': self._user_agent,
+                            'Content-Type': 'application/json',
+                            'Authorization': 'Bearer ' + id_token
+                        }
+                        self._session = [session, headers]
+                        self._set_expiry(id_token)
+                        break
+                    else:
+                        logger.error(await response.text())
+
+            except aiohttp.ClientError as err:
+                logger.error(f"Не удалось авторизоваться в NTTM: {err}")
+            await asyncio.sleep(5)
+
+    def _set_expiry(self, id_token: str) -> None:
+        now = datetime.now()
+        try:
+            payload = id_token.split('.')[1]
+            payload += '=' * (-len(payload) % 4)
+            expires = datetime.fromtimestamp(json.loads(base64.urlsafe_b64decode(payload))['exp'])
+        except (IndexError, KeyError, TypeError, ValueError) as err:
+            logger.warning(f"Не удалось определить срок жизни токена: {err}")
+            expires = now + timedelta(hours=6)
+
+        self._timer = expires
+        self._refresh_at = expires - min(timedelta(minutes=5), (expires - now) / 2)
 
     async def _get_session(self) -> list[aiohttp.ClientSession, dict]:
-        if self._active_session == 0:
-            self._active_session += 1
-            await self._create_session()
-            self._timer = datetime.now() + timedelta(hours=6)
+        now = datetime.now()
+        if self._session and now < self._timer:
+            if now >= self._refresh_at and (self._refresh_task is None or self._refresh_task.done()):
+                self._refresh_task = self._loop.create_task(self._refresh_session())
+            return self._session
 
-        elif datetime.now() > self._timer:
-            await self._logout()
-            await self._create_session()
-            self._timer = datetime.now() + timedelta(hours=6)
+        await self._refresh_session()
         return self._session
 
-    async def _logout(self) -> Coroutine:
-        session, headers = self._session
-        try:
-            await session.get(self._url + "/nttm-task-handler/api/logout", headers=headers, timeout=10)
-        except Exception as err:
-            logger.error(f"Не удалось выйти из NTTM: {err}")
-
-        await session.close()
-        self._session.clear()
+    async def _refresh_session(self) -> Coroutine:
+        async with self._auth_lock:
+            if self._session and datetime.now() < self._refresh_at:
+                return
+            logger.info("Обновление сессии NTTM")
+            await self._create_session()
 
-    async def _close_session(self, code: int) -> Coroutine:
-        if code != 200 and self._active_session == 1:
-            if self._session:
-                self._active_session -= 1
-                await self._session[0].close()
-                await self._logout()
+    async def _close_session(self, code: int, headers: dict) -> Coroutine:
+        if code in (401, 403) and self._session and self._session[1] is headers:
+            self._session = []
 
     async def _draft(self, method: str, url: str, timeout=10, params=None, data=None, json_=None) -> Coroutine:
         code, result = None, None
         request_data = {'method': method, 'url': url, 'timeout': timeout,
                         'params': params, 'data': data, 'json': json_}
 
-        for _ in range(3):
+        for attempt in range(self._retry.attempts):
+            if not self._breaker.allow():
+                code, result = 503, 'Custom error: NTTM is unavailable (circuit breaker is open)'
+                break
+
+            outcome, retry_after = 'retry', None
             try:
                 session, headers = await self._get_session()
-                response = await session.request(**request_data, headers=headers)
-                code = response.status
-
-                if code == 200:
-                    try:
-                        result = await response.json()
-                    except json.JSONDecodeError as err:
-                        logger.warning(err)
-                        result = await response.text()
-                    await self._close_session(code)
-                    break
-
-                elif code == 400:
-                    result = await response.text()
-                    await self._close_session(code)
-                    break
+                await self._limiter(url).acquire()
+                started = time.perf_counter()
+                async with session.request(**request_data, headers=headers) as response:
+                    code = response.status
+                    outcome = self._retry.classify(code)
 
-                else:
-                    result = await response.text()
-                    await self._close_session(code)
-                    logger.error(result)
-                    await asyncio.sleep(1)
+                    if code == 200:
+                        try:
+                            result = await response.json()
+                        except (json.JSONDecodeError, aiohttp.ContentTypeError) as err:
+                            logger.warning(err)
+                            result = await response.text()
+                    else:
+                        result = await response.text()
+                        retry_after = response.headers.get('Retry-After')
+                http_seconds.observe(time.perf_counter() - started, request=self._request_kind(url), code=code)
+                await self._close_session(code, headers)
 
             except Exception as err:
                 code, result = 400, err
                 logger.error(err, exc_info=True)
-                await self._close_session(code)
-                await asyncio.sleep(1)
+
+            http_responses.inc(request=self._request_kind(url), code=code)
+            if outcome == 'retry':
+                self._breaker.record_failure()
+            else:
+                self._breaker.record_success()
+
+            if outcome in ('success', 'fatal'):
+                break
+
+            if attempt + 1 < self._retry.attempts:
+                logger.warning(f"Повтор запроса {url} ({code}), попытка {attempt + 2}: {str(result)[:200]}")
+                self._retry.record_retry(code)
+                if outcome == 'retry':
+                    await asyncio.sleep(self._retry.delay(attempt, retry_after))
+            else:
+                logger.error(f"Запрос {url} не выполнен ({code}): {str(result)[:200]}")
+                self._retry.record_exhausted()
 
         return code, result
 
@@ -163,26 +306,29 @@ class ConnectorNTTM:
                 else:
                     if not filter_key == "5481e1e0-0ff7-4dec-a183-96ee95a61c29":
                         filter_ = modify_filter(result['result'])
-                        size, request = 100, "ticket"
+                        request = "ticket"
                     else:
                         filter_ = result['filter'].encode('utf-8')
-                        size, request = 500, "task"
+                        request = "task"
 
                     url_tasks = f"{self._url}/nttm-web-gateway/api/{request}/page"
                     params = {"page": "0",
-                              "size": f"{size}",
+                              "size": f"{self._page_sizes[request]}",
                               "sort": "id,desc"}
 
                     tasks = []
-                    code, result = await self._draft(method='POST', url=url_tasks, timeout=90,
-                                                     params=params, data=filter_)
+                    code, result = await self._get_page(request, url_tasks, params, filter_, 0)
                     if code == 200:
                         tasks.extend(result['content'])
                         if result['totalPages'] > 1:
-                            for page in range(1, result['totalPages']):
-                                params['page'] = str(int(params['page']) + 1)
-                                code, result = await self._draft(method='POST', url=url_tasks, timeout=90,
-                                                                 params=params, data=filter_)
+                            semaphore = asyncio.Semaphore(self._page_concurrency)
+
+                            async def fetch(page: int) -> tuple[int, dict]:
+                                async with semaphore:
+                                    return await self._get_page(request, url_tasks, params, filter_, page)
+
+                            pages = await asyncio.gather(*(fetch(page) for page in range(1, result['totalPages'])))
+                            for code, result in pages:
                                 if code == 200:
                                     tasks.extend(result['content'])
                                 else:
@@ -192,79 +338,165 @@ class ConnectorNTTM:
                         tasks = result
             else:
                 tasks = result
-            self.results.put_nowait({'task_id': task_id, 'status_code': code, 'result': tasks})
+            await self.results.put({'task_id': task_id, 'status_code': code, 'result': tasks})
 
         except Exception as err:
             logger.error(err, exc_info=True)
-            self.results.put_nowait({'task_id': task_id, 'status_code': 400, 'result': f'fatal error: {err}'})
+            await self.results.put({'task_id': task_id, 'status_code': 400, 'result': f'fatal error: {err}'})
+
+    async def _get_page(self, request: str, url: str, params: dict, filter_: bytes, page: int) -> tuple[int, dict]:
+        params = dict(params, page=str(page))
+        code, result = None, None
+
+        for attempt in range(1 + self._page_retries):
+            started = time.monotonic()
+            code, result = await self._draft(method='POST', url=url, timeout=90, params=params, data=filter_)
+            if code == 200:
+                self._adapt_page_size(request, time.monotonic() - started)
+                break
+            logger.warning(f"Не удалось получить страницу {page} ({request}), попытка {attempt + 1}: {code}")
+        return code, result
+
+    def _adapt_page_size(self, request: str, elapsed: float) -> None:
+        size = self._page_sizes[request]
+        lower, upper = self._page_limits
+
+        if elapsed < self._page_time[0]:
+            size = min(size * 2, upper)
+        elif elapsed > self._page_time[1]:
+            size = max(size // 2, lower)
+        self._page_sizes[request] = size
 
     async def _get_incident(self, task_id: int, inc: int) -> Coroutine:
         try:
             url = f"{self._url}/nttm-web-gateway/api/ticket/{inc}"
             code, result = await self._draft('GET', url)
-            self.results.put_nowait({'task_id': task_id, 'status_code': code, 'result': result})
+            await self.results.put({'task_id': task_id, 'status_code': code, 'result': result})
 
         except Exception as err:
             logger.error(err, exc_info=True)
-            self.results.put_nowait({'task_id': task_id, 'status_code': 400, 'result': f'fatal error: {err}'})
+            await self.results.put({'task_id': task_id, 'status_code': 400, 'result': f'fatal error: {err}'})
+
+    async def _get_incidents(self, task_id: int, incs: list) -> Coroutine:
+        async def fetch(inc: str) -> dict:
+            try:
+                code, result = await self._draft('GET', f"{self._url}/nttm-web-gateway/api/ticket/{inc}")
+                if code != 200:
+                    result = str(result)
+            except Exception as err:
+                code, result = 400, f'fatal error: {err}'
+            return {'inc': inc, 'status_code': code, 'result': result}
+
+        try:
+            result = await asyncio.gather(*(fetch(inc) for inc in incs))
+            await self.results.put({'task_id': task_id, 'status_code': 200, 'result': result})
+
+        except Exception as err:
+            logger.error(err, exc_info=True)
+            await self.results.put({'task_id': task_id, 'status_code': 400, 'result': f'fatal error: {err}'})
+
+    def queue_stats(self) -> dict[str, int]:
+        return {'tasks': self.tasks.qsize(), 'results': self.results.qsize(),
+                'running': self._running, 'capacity': self.capacity}
+
+    def reset(self) -> None:
+        """Очищает очереди прежнего подключения: незавершённые задания сервер выдаст заново"""
+        for queue in (self.tasks, self.results):
+            while not queue.empty():
+                queue.get_nowait()
+
+    @property
+    def available(self) -> int:
+        """
+        Сколько заданий клиент готов принять после подключения: задания прежнего подключения,
+        которые ещё выполняются, занимают свои места и вернут кредит по завершении
+        """
+        return self.capacity - self._running
+
+    def _release(self, _: asyncio.Task) -> None:
+        self._running -= 1
+        self._slots.release()
 
     async def _core(self) -> Awaitable:
         task = {'task_id': None}
 
         while True:
             try:
-                task = self.tasks.get_nowait()
+                task = await self.tasks.get()
 
                 if task.get('type') == 'get_tasks':
-                    self._loop.create_task(self._get_tasks(task['task_id'], task['filter']))
+                    method, args = self._get_tasks, (task['task_id'], task['filter'])
                 elif task.get('type') == 'get_inc':
-                    self._loop.create_task(self._get_incident(task['task_id'], task['inc']))
+                    method, args = self._get_incident, (task['task_id'], task['inc'])
+                elif task.get('type') == 'get_incs':
+                    method, args = self._get_incidents, (task['task_id'], task['incs'])
                 else:
                     result = {'type': 'event', 'message': f'task type ({task.get("type")}) not found',
                               'task_id': task['task_id'], 'status_code': None}
-                    self.results.put_nowait(result)
+                    await self.results.put(result)
+                    continue
+
+                self._running += 1
+                await self._slots.acquire()
+                self._loop.create_task(method(*args)).add_done_callback(self._release)
 
-            except asyncio.QueueEmpty:
-                await asyncio.sleep(0.01)
             except Exception as err:
                 logging.error(err, exc_info=True)
-                self.results.put_nowait({'type': 'event', 'message': err, 'task_id': task['task_id']})
+                await self.results.put({'type': 'event', 'message': err, 'task_id': task['task_id']})
 
 
 async def main() -> Awaitable:
+    await metrics.serve(metrics_port)
+    loop = asyncio.get_running_loop()
+    nttm = ConnectorNTTM(loop)
+    nttm.register_metrics()
+
     def sha256(data: str) -> hashlib.hash_object:
         hash_object = hashlib.sha256(bytes(token + data + key, encoding='utf-8'))
         hex_dig = hash_object.hexdigest()
         return hex_dig
 
-    async def sender_analyst(websocket: websockets.connect, service: ConnectorNTTM) -> Coroutine:
+    async def sender_analyst(websocket: websockets.connect, service: ConnectorNTTM, codec: MessageCodec) -> Coroutine:
+        async def send(message: dict) -> None:
+            for frame in codec.encode(message):
+                await websocket.send(frame)
+
+        await send({'type': 'credit', 'credit': service.available})
+        returned, batch = 0, max(1, service.capacity // 4)
+
         while websocket.open:
-            try:
-                result = json.dumps(service.results.get_nowait())
-                await websocket.send(result)
-                logger.debug(f"{websocket.remote_address} sending: {str(result)[:50]}")
+            result = await service.results.get()
+            await send(result)
+            logger.debug(f"{websocket.remote_address} sending: {str(result)[:50]}")
 
-            except asyncio.QueueEmpty:
-                await asyncio.sleep(0.01)
+            returned += 1
+            if returned >= batch or service.results.empty():
+                await send({'type': 'credit', 'credit': returned})
+                returned = 0
 
     while True:
         try:
-            async with websockets.connect(server) as ws:
+            async with websockets.connect(server, max_size=10240000, compression=compression or None,
+                                          subprotocols=subprotocols(codecs)) as ws:
                 await ws.send(token)
                 salt = await ws.recv()
                 await ws.send(sha256(salt))
                 await ws.send('nttm')
 
-                logger.info('ws client connecting')
-                loop = asyncio.get_event_loop()
-                nttm = ConnectorNTTM(loop)
-                loop.create_task(sender_analyst(ws, nttm))
-
-                async for message in ws:
-                    mes = json.loads(message)
-                    logger.debug(f"{ws.remote_address} recv: {mes}")
-                    nttm.tasks.put_nowait(mes)
-                    await asyncio.sleep(0.01)
+                codec = MessageCodec(ws.subprotocol, chunk_size)
+                logger.info(f'ws client connecting (codec {codec.name})')
+                nttm.reset()
+                sender = loop.create_task(sender_analyst(ws, nttm, codec))
+
+                try:
+                    async for message in ws:
+                        mes = codec.decode(message)
+                        if mes is None:
+                            continue
+                        logger.debug(f"{ws.remote_address} recv: {mes}")
+                        await nttm.tasks.put(mes)
+                finally:
+                    sender.cancel()
 
         except Exception as err:
             logging.error(err)
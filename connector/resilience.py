@@ -0,0 +1,147 @@
+import asyncio
+import random
+import time
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+
+
+class RetryPolicy:
+    """
+    Класс политики повторных запросов к системе NTTM:
+    1. Классифицирует ответ по статусу (успех, ошибка без повтора, повтор, повторная авторизация)
+    2. Считает задержку перед повтором: экспонента с полным джиттером, либо значение Retry-After
+    3. Ведёт счётчики повторов по статусам
+    """
+
+    retry_codes = (408, 425, 429, 500, 502, 503, 504)
+    auth_codes = (401, 403)
+
+    def __init__(self, attempts: int, base: float, maximum: float) -> None:
+        self.attempts = attempts
+        self._base = base
+        self._maximum = maximum
+        self._stats = {'retries': 0, 'exhausted': 0, 'by_status': {}}
+
+    def classify(self, code: int | None) -> str:
+        if code == 200:
+            return 'success'
+        if code in self.auth_codes:
+            return 'auth'
+        if code is None or code in self.retry_codes:
+            return 'retry'
+        return 'fatal'
+
+    def delay(self, attempt: int, retry_after: str = None) -> float:
+        if retry_after:
+            try:
+                return min(float(retry_after), self._maximum)
+            except ValueError:
+                pass
+            try:
+                seconds = (parsedate_to_datetime(retry_after) - datetime.now().astimezone()).total_seconds()
+                return min(max(seconds, 0.0), self._maximum)
+            except (TypeError, ValueError):
+                pass
+        return random.uniform(0, min(self._maximum, self._base * 2 ** attempt))
+
+    def record_retry(self, code: int | None) -> None:
+        self._stats['retries'] += 1
+        self._stats['by_status'][code] = self._stats['by_status'].get(code, 0) + 1
+
+    def record_exhausted(self) -> None:
+        self._stats['exhausted'] += 1
+
+    def stats(self) -> dict:
+        return dict(self._stats, by_status=dict(self._stats['by_status']))
+
+
+class CircuitBreaker:
+    """
+    Класс автоматического выключателя запросов к системе NTTM:
+    1. closed - запросы проходят, считаются подряд идущие сбои
+    2. open - после порога сбоев запросы сразу отклоняются в течение периода сброса
+    3. half_open - по истечении периода пропускается один пробный запрос,
+       успех закрывает выключатель, сбой снова открывает его
+    """
+
+    def __init__(self, threshold: int, reset_timeout: float) -> None:
+        self._threshold = threshold
+        self._reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe = False
+        self.state = 'closed'
+        self._stats = {'opened': 0, 'rejected': 0}
+
+    def allow(self) -> bool:
+        if self.state == 'closed':
+            return True
+
+        if self.state == 'open' and time.monotonic() - self._opened_at >= self._reset_timeout:
+            self.state = 'half_open'
+            self._probe = False
+
+        if self.state == 'half_open' and not self._probe:
+            self._probe = True
+            return True
+
+        self._stats['rejected'] += 1
+        return False
+
+    def record_success(self) -> None:
+        self._failures = 0
+        self.state = 'closed'
+
+    def record_failure(self) -> None:
+        self._failures += 1
+        if self.state == 'half_open' or self._failures >= self._threshold:
+            if self.state != 'open':
+                self._stats['opened'] += 1
+            self.state = 'open'
+            self._opened_at = time.monotonic()
+
+    def stats(self) -> dict:
+        return dict(self._stats, state=self.state, failures=self._failures)
+
+
+class TokenBucket:
+    """
+    Класс ограничителя частоты запросов к системе NTTM (token bucket):
+    1. Корзина пополняется со скоростью rate токенов в секунду, но не более burst токенов
+    2. Каждый запрос забирает токен, при пустой корзине запрос ждёт в очереди (FIFO)
+    3. Ведёт статистику времени ожидания в очереди, rate = 0 отключает ограничение
+    """
+
+    def __init__(self, rate: float, burst: float = None) -> None:
+        self._rate = rate
+        self._burst = burst or max(rate, 1)
+        self._tokens = self._burst
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+        self._stats = {'acquired': 0, 'delayed': 0, 'waited_total': 0.0, 'waited_max': 0.0}
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self._burst, self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+
+    async def acquire(self) -> float:
+        started = time.monotonic()
+        if self._rate > 0:
+            async with self._lock:
+                self._refill()
+                while self._tokens < 1:
+                    await asyncio.sleep((1 - self._tokens) / self._rate)
+                    self._refill()
+                self._tokens -= 1
+
+        waited = time.monotonic() - started
+        self._stats['acquired'] += 1
+        if waited > 0.001:
+            self._stats['delayed'] += 1
+        self._stats['waited_total'] += waited
+        self._stats['waited_max'] = max(self._stats['waited_max'], waited)
+        return waited
+
+    def stats(self) -> dict:
+        return dict(self._stats, rate=self._rate, burst=self._burst)